@@ -1,13 +1,23 @@
 import sqlite3
-from contextlib import closing
+import atexit
+import calendar
+import queue
+import threading
+from contextlib import closing, contextmanager
 from datetime import date, datetime, timedelta
+import numpy as np
 import pandas as pd
 import streamlit as st
 import altair as alt
 import bcrypt
-import io
-import uuid
+try:
+    import duckdb  # Optional: columnar engine for dashboard aggregates
+except ImportError:
+    duckdb = None
+import itertools
+import json
 import os
+import hashlib
 from typing import Optional, Any, Dict, List
 
 # ---------- MUST BE FIRST STREAMLIT COMMAND ----------
@@ -17,17 +27,272 @@ st.set_page_config(page_title="💊 Pharmacy Management", layout="wide")
 DB_PATH = "pharmacy.db"
 APP_TITLE = "💊 Pharmacy Management"
 DEFAULT_ADMIN_PASSWORD = os.getenv("ADMIN_PASSWORD", "admin123")  # Configurable via environment variable
+# bcrypt cost factor; each step doubles hashing time. 11 (~half of bcrypt's default 12) is still
+# well above brute-force-practical for this app's local staff logins.
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "11"))
+
+# ---------- SEED DATA ----------
+# Sample rows inserted by init_db into an empty database; products reference categories by name.
+_SEED_CATEGORIES = (
+    ("Analgesics",), ("Antibiotics",), ("Antihistamines",), ("Antihypertensives",), ("Antidiabetics",),
+    ("Antidepressants",), ("Antianxiety Agents",), ("Antivirals",), ("Antifungals",), ("Antacids & GI Drugs",),
+    ("Cardiovascular Drugs",), ("Respiratory Drugs",), ("Vitamins & Supplements",), ("Hormonal Agents",),
+    ("Anticoagulants",), ("Anti-inflammatory Drugs",), ("Anticonvulsants",), ("Dermatologicals",),
+    ("Ophthalmic Drugs",), ("OTC Medications",),
+)
+
+_SEED_PRODUCTS = (
+    # Analgesics (6 products)
+    ("Ibuprofen 200mg", "Analgesics", 100, 5.99, 3.50, 20, "Supplier A", "2026-12-31"),
+    ("Acetaminophen 500mg", "Analgesics", 150, 4.99, 2.80, 30, "Supplier B", "2026-11-15"),
+    ("Aspirin 325mg", "Analgesics", 80, 3.49, 2.00, 15, "Supplier A", "2027-03-20"),
+    ("Naproxen 250mg", "Analgesics", 60, 6.49, 3.90, 10, "Supplier C", "2026-09-10"),
+    ("Diclofenac Gel 1%", "Analgesics", 40, 12.99, 8.00, 10, "Supplier B", "2027-01-05"),
+    ("Paracetamol 650mg", "Analgesics", 120, 5.49, 3.20, 25, "Supplier A", "2026-10-30"),
+    # Antibiotics (6 products)
+    ("Amoxicillin 500mg", "Antibiotics", 50, 8.99, 5.50, 10, "Supplier D", "2026-08-25"),
+    ("Azithromycin 250mg", "Antibiotics", 30, 10.99, 6.80, 5, "Supplier E", "2026-07-15"),
+    ("Ciprofloxacin 500mg", "Antibiotics", 40, 12.49, 7.50, 10, "Supplier D", "2026-12-10"),
+    ("Doxycycline 100mg", "Antibiotics", 60, 9.99, 6.00, 15, "Supplier E", "2027-02-28"),
+    ("Clindamycin 300mg", "Antibiotics", 25, 15.99, 9.50, 5, "Supplier D", "2026-11-30"),
+    ("Erythromycin 500mg", "Antibiotics", 35, 11.49, 7.00, 10, "Supplier E", "2026-09-30"),
+    # Antihistamines (6 products)
+    ("Cetirizine 10mg", "Antihistamines", 80, 6.49, 3.80, 15, "Supplier F", "2026-10-10"),
+    ("Loratadine 10mg", "Antihistamines", 100, 5.99, 3.50, 20, "Supplier F", "2027-03-05"),
+    ("Fexofenadine 180mg", "Antihistamines", 60, 9.99, 6.00, 10, "Supplier G", "2026-11-25"),
+    ("Diphenhydramine 25mg", "Antihistamines", 70, 4.99, 2.90, 15, "Supplier F", "2026-09-20"),
+    ("Chlorpheniramine 4mg", "Antihistamines", 50, 3.99, 2.30, 10, "Supplier G", "2027-02-15"),
+    ("Desloratadine 5mg", "Antihistamines", 40, 10.49, 6.30, 10, "Supplier F", "2026-12-20"),
+    # Antihypertensives (4 products)
+    ("Lisinopril 10mg", "Antihypertensives", 90, 6.99, 4.20, 20, "Supplier H", "2026-10-20"),
+    ("Amlodipine 5mg", "Antihypertensives", 100, 8.49, 5.10, 20, "Supplier H", "2027-01-25"),
+    ("Losartan 50mg", "Antihypertensives", 60, 9.49, 5.70, 15, "Supplier I", "2027-03-10"),
+    ("Hydrochlorothiazide 25mg", "Antihypertensives", 80, 5.49, 3.30, 15, "Supplier H", "2026-12-05"),
+    # Antidiabetics (3 products)
+    ("Metformin 500mg", "Antidiabetics", 100, 7.99, 4.80, 20, "Supplier J", "2027-02-15"),
+    ("Glipizide 5mg", "Antidiabetics", 70, 6.99, 4.20, 15, "Supplier J", "2026-11-30"),
+    ("Insulin Glargine 100U/mL", "Antidiabetics", 20, 49.99, 30.00, 5, "Supplier K", "2026-09-15"),
+    # Antidepressants (3 products)
+    ("Sertraline 50mg", "Antidepressants", 50, 9.99, 6.00, 10, "Supplier L", "2027-01-10"),
+    ("Fluoxetine 20mg", "Antidepressants", 60, 8.49, 5.10, 10, "Supplier L", "2026-12-20"),
+    ("Escitalopram 10mg", "Antidepressants", 40, 10.99, 6.60, 10, "Supplier M", "2027-03-05"),
+    # Antianxiety Agents (2 products)
+    ("Lorazepam 1mg", "Antianxiety Agents", 30, 11.99, 7.20, 5, "Supplier N", "2026-10-15"),
+    ("Alprazolam 0.5mg", "Antianxiety Agents", 25, 12.49, 7.50, 5, "Supplier N", "2026-11-10"),
+    # Antivirals (2 products)
+    ("Oseltamivir 75mg", "Antivirals", 20, 29.99, 18.00, 5, "Supplier O", "2026-08-30"),
+    ("Acyclovir 400mg", "Antivirals", 30, 14.99, 9.00, 5, "Supplier O", "2026-12-10"),
+    # Antifungals (2 products)
+    ("Fluconazole 150mg", "Antifungals", 25, 15.99, 9.60, 5, "Supplier P", "2026-11-25"),
+    ("Clotrimazole Cream 1%", "Antifungals", 50, 7.99, 4.80, 10, "Supplier P", "2027-02-20"),
+    # Antacids & GI Drugs (2 products)
+    ("Omeprazole 20mg", "Antacids & GI Drugs", 60, 8.99, 5.40, 15, "Supplier Q", "2027-01-15"),
+    ("Loperamide 2mg", "Antacids & GI Drugs", 80, 4.99, 3.00, 20, "Supplier Q", "2026-10-30"),
+    # Cardiovascular Drugs (3 products)
+    ("Atenolol 50mg", "Cardiovascular Drugs", 70, 7.99, 4.80, 15, "Supplier R", "2027-04-15"),
+    ("Simvastatin 20mg", "Cardiovascular Drugs", 50, 8.99, 5.40, 10, "Supplier R", "2026-11-20"),
+    ("Clopidogrel 75mg", "Cardiovascular Drugs", 60, 10.49, 6.30, 10, "Supplier S", "2027-03-10"),
+    # Respiratory Drugs (2 products)
+    ("Albuterol Inhaler 90mcg", "Respiratory Drugs", 30, 24.99, 15.00, 5, "Supplier T", "2026-09-30"),
+    ("Montelukast 10mg", "Respiratory Drugs", 50, 9.99, 6.00, 10, "Supplier T", "2027-02-28"),
+    # Vitamins & Supplements (6 products)
+    ("Vitamin C 1000mg", "Vitamins & Supplements", 200, 4.99, 2.90, 30, "Supplier U", "2027-06-30"),
+    ("Vitamin D3 2000IU", "Vitamins & Supplements", 180, 5.49, 3.20, 25, "Supplier U", "2027-05-15"),
+    ("Multivitamin Tablets", "Vitamins & Supplements", 150, 6.99, 4.10, 20, "Supplier V", "2027-04-20"),
+    ("Vitamin B12 500mcg", "Vitamins & Supplements", 120, 5.99, 3.50, 20, "Supplier U", "2026-12-15"),
+    ("Omega-3 Fish Oil 1000mg", "Vitamins & Supplements", 100, 8.99, 5.30, 15, "Supplier V", "2027-02-10"),
+    ("Calcium 600mg + D3", "Vitamins & Supplements", 90, 7.49, 4.40, 15, "Supplier U", "2027-01-30"),
+    # Hormonal Agents (2 products)
+    ("Levothyroxine 100mcg", "Hormonal Agents", 60, 9.49, 5.70, 10, "Supplier W", "2027-03-15"),
+    ("Ethinyl Estradiol 0.03mg", "Hormonal Agents", 40, 12.99, 7.80, 10, "Supplier W", "2026-12-10"),
+    # Anticoagulants (2 products)
+    ("Warfarin 5mg", "Anticoagulants", 50, 8.49, 5.10, 10, "Supplier X", "2027-01-20"),
+    ("Apixaban 5mg", "Anticoagulants", 30, 19.99, 12.00, 5, "Supplier X", "2026-11-30"),
+    # Anti-inflammatory Drugs (2 products)
+    ("Prednisone 10mg", "Anti-inflammatory Drugs", 60, 6.99, 4.20, 10, "Supplier Y", "2026-10-25"),
+    ("Celecoxib 200mg", "Anti-inflammatory Drugs", 40, 13.99, 8.40, 10, "Supplier Y", "2027-02-10"),
+    # Anticonvulsants (2 products)
+    ("Gabapentin 300mg", "Anticonvulsants", 50, 10.99, 6.60, 10, "Supplier Z", "2026-12-15"),
+    ("Levetiracetam 500mg", "Anticonvulsants", 40, 12.49, 7.50, 10, "Supplier Z", "2027-01-30"),
+    # Dermatologicals (2 products)
+    ("Hydrocortisone Cream 1%", "Dermatologicals", 50, 6.99, 4.20, 10, "Supplier AA", "2027-02-25"),
+    ("Mupirocin Ointment 2%", "Dermatologicals", 30, 11.99, 7.20, 5, "Supplier AA", "2026-11-15"),
+    # Ophthalmic Drugs (2 products)
+    ("Artificial Tears 0.5%", "Ophthalmic Drugs", 60, 5.99, 3.60, 10, "Supplier BB", "2027-03-20"),
+    ("Timolol Eye Drops 0.5%", "Ophthalmic Drugs", 25, 14.99, 9.00, 5, "Supplier BB", "2026-12-05"),
+    # OTC Medications (2 products)
+    ("Loperamide 2mg", "OTC Medications", 80, 4.99, 3.00, 20, "Supplier CC", "2026-10-30"),
+    ("Acetaminophen 500mg", "OTC Medications", 150, 4.99, 2.80, 30, "Supplier CC", "2026-11-15"),
+)
 
 # ---------- DATABASE HELPERS ----------
-def get_connection():
-    """Returns a connection to the SQLite database with row_factory set to sqlite3.Row."""
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+# Shared by the writer and the read-only connections; journal_mode is only set on the writer.
+CONNECTION_PRAGMAS = """
+PRAGMA synchronous=NORMAL;
+PRAGMA busy_timeout=5000;
+PRAGMA cache_size=-20000;
+PRAGMA temp_store=MEMORY;
+PRAGMA foreign_keys=ON;
+PRAGMA mmap_size=268435456;
+"""
+# Prepared statements kept per connection; helpers use fixed SQL text so they hit this cache.
+STATEMENT_CACHE_SIZE = 256
+
+def get_connection(db_path: str = DB_PATH):
+    """Returns a connection to the SQLite database with row_factory set to sqlite3.Row.
+
+    The connection runs in WAL mode with synchronous=NORMAL, an in-memory temp store and
+    a larger page cache/mmap window so writes need fewer fsyncs and readers never block the writer.
+    """
+    conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None, cached_statements=STATEMENT_CACHE_SIZE)
+    conn.row_factory = sqlite3.Row
+    conn.executescript("PRAGMA journal_mode=WAL;" + CONNECTION_PRAGMAS)
+    conn.execute("PRAGMA wal_autocheckpoint=1000")
+    return conn
+
+@contextmanager
+def immediate(conn):
+    """Runs the block inside a BEGIN IMMEDIATE transaction, committing on success and rolling back on error.
+
+    Taking the write lock up front makes a concurrent writer wait on busy_timeout instead of
+    failing with SQLITE_BUSY when a deferred transaction tries to upgrade its lock.
+    """
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+        conn.execute("COMMIT")
+    except BaseException:
+        # SQLite may already have rolled back on its own (e.g. after a failed COMMIT or SQLITE_FULL)
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+
+def get_read_connection(db_path: str = DB_PATH):
+    """Returns a read-only connection to the SQLite database with row_factory set to sqlite3.Row."""
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, check_same_thread=False, cached_statements=STATEMENT_CACHE_SIZE)
     conn.row_factory = sqlite3.Row
+    conn.executescript(CONNECTION_PRAGMAS)
     return conn
 
+class ConnectionPool:
+    """One writer connection plus a queue of read-only connections.
+
+    WAL lets any number of readers run alongside the single writer, so page reads no longer
+    queue up behind record_sale/adjust_stock. Writers are serialized by a lock.
+    """
+
+    def __init__(self, db_path: str = DB_PATH, readers: Optional[int] = None):
+        self.write_conn = get_connection(db_path)
+        self._write_lock = threading.Lock()
+        self._readers: "queue.Queue[sqlite3.Connection]" = queue.Queue()
+        for _ in range(readers or os.cpu_count() or 4):
+            self._readers.put(get_read_connection(db_path))
+
+    @contextmanager
+    def read(self):
+        """Borrows a read-only connection for the duration of the block."""
+        conn = self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put(conn)
+
+    @contextmanager
+    def write(self):
+        """Yields the writer connection, holding the write lock for the duration of the block."""
+        with self._write_lock:
+            yield self.write_conn
+
+    def close(self):
+        """Closes the writer and all idle read-only connections."""
+        while not self._readers.empty():
+            self._readers.get_nowait().close()
+        self.write_conn.close()
+
+@st.cache_resource
+def get_pool() -> ConnectionPool:
+    """Returns the process-wide connection pool, creating it and the schema on first use.
+
+    Cached as a resource so every session and rerun shares the same open handles; the pool is
+    closed when the process exits.
+    """
+    pool = ConnectionPool(DB_PATH)
+    with pool.write() as conn:
+        init_db(conn)
+    atexit.register(pool.close)
+    return pool
+
+@st.cache_resource
+def get_analytics_conn():
+    """Returns an in-memory DuckDB connection with the SQLite database attached read-only.
+
+    Returns None when duckdb (or its sqlite extension) is unavailable; callers then aggregate in SQLite.
+    """
+    if duckdb is None:
+        return None
+    try:
+        duck = duckdb.connect(":memory:")
+        duck.execute("INSTALL sqlite; LOAD sqlite;")
+        db_file = os.path.abspath(DB_PATH).replace("'", "''")
+        duck.execute(f"ATTACH '{db_file}' AS pharm (TYPE sqlite, READ_ONLY)")
+    except duckdb.Error:
+        # No sqlite extension (e.g. offline install); aggregates fall back to SQLite
+        return None
+    atexit.register(duck.close)
+    return duck
+
+@st.cache_resource
+def _revisions() -> Dict[str, int]:
+    """Process-wide mutation counters, one per table, shared by every session."""
+    return {"products": 0, "categories": 0, "users": 0, "sales": 0}
+
+def bump_revision(*tables: str):
+    """Marks tables as modified so cached reads keyed on their revision are refetched."""
+    revisions = _revisions()
+    for table in tables:
+        revisions[table] += 1
+
+def revision_key(*tables: str) -> tuple:
+    """Returns the current revisions of the given tables, for use as a cache key."""
+    revisions = _revisions()
+    return tuple(revisions[table] for table in tables)
+
 def init_db(conn):
-    """Create schema and insert sample data if tables are empty."""
+    """Create schema and insert sample data if tables are empty.
+
+    Schema creation and migrations commit at synchronous=NORMAL; only the seeding of an empty
+    database, which has nothing to lose on a crash, runs as one transaction with synchronous=OFF.
+    """
     cur = conn.cursor()
+    with immediate(conn):
+        _create_schema(cur)
+        # An already populated database needs none of the per-table seed checks
+        cur.execute(
+            "SELECT EXISTS(SELECT 1 FROM users) AND EXISTS(SELECT 1 FROM categories) AND EXISTS(SELECT 1 FROM products)"
+        )
+        populated = cur.fetchone()[0]
+    if not populated:
+        conn.execute("PRAGMA synchronous=OFF")
+        try:
+            with immediate(conn):
+                _insert_samples(cur)
+        finally:
+            conn.execute("PRAGMA synchronous=NORMAL")
+    with immediate(conn):
+        # Gather planner statistics once; afterwards let SQLite decide whether they need refreshing
+        cur.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'")
+        cur.execute("ANALYZE" if cur.fetchone() is None else "PRAGMA optimize")
+
+def _add_column(cur, table: str, column: str, decl: str) -> bool:
+    """Adds a column to an existing table unless it is already there; returns True if it was added."""
+    cur.execute(f"PRAGMA table_info({table})")
+    if any(row["name"] == column for row in cur.fetchall()):
+        return False
+    cur.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+    return True
+
+def _create_schema(cur):
+    """Creates tables, the products view and indexes, migrating older databases in place."""
     # Users
     cur.execute(
         """
@@ -82,6 +347,7 @@ def init_db(conn):
             total REAL NOT NULL,
             sold_by INTEGER,
             sold_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            sold_at_ts INTEGER,
             FOREIGN KEY(product_id) REFERENCES products(id),
             FOREIGN KEY(sold_by) REFERENCES users(id)
         )
@@ -97,145 +363,88 @@ def init_db(conn):
             reason TEXT,
             adjusted_by INTEGER,
             adjusted_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            adjusted_at_ts INTEGER,
             FOREIGN KEY(product_id) REFERENCES products(id),
             FOREIGN KEY(adjusted_by) REFERENCES users(id)
         )
         """
     )
+    # Invoice Counters - last invoice sequence issued per day (YYMMDD)
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS invoice_counters (
+            day TEXT PRIMARY KEY,
+            last_seq INTEGER NOT NULL DEFAULT 0
+        )
+        """
+    )
+    # Integer epoch copies of the ISO timestamps, used for range filters (the TEXT columns stay for display)
+    if _add_column(cur, "sales", "sold_at_ts", "INTEGER"):
+        cur.execute("UPDATE sales SET sold_at_ts = CAST(strftime('%s', sold_at) AS INTEGER) WHERE sold_at_ts IS NULL")
+    if _add_column(cur, "stock_adjustments", "adjusted_at_ts", "INTEGER"):
+        cur.execute(
+            "UPDATE stock_adjustments SET adjusted_at_ts = CAST(strftime('%s', adjusted_at) AS INTEGER) WHERE adjusted_at_ts IS NULL"
+        )
+    # Products joined with their category plus derived stock/expiry flags; recreated so
+    # definition changes reach existing databases
+    cur.execute("DROP VIEW IF EXISTS v_products_enriched")
+    cur.execute(
+        """
+        CREATE VIEW v_products_enriched AS
+        SELECT p.*,
+               c.name AS category_name,
+               (p.quantity <= p.reorder_level) AS low_stock,
+               CAST(julianday(p.expiry_date) - julianday('now', 'localtime', 'start of day') AS INTEGER) AS days_to_expiry
+        FROM products p
+        LEFT JOIN categories c ON p.category_id = c.id
+        """
+    )
     # Add indexes for optimization
     cur.execute("CREATE INDEX IF NOT EXISTS idx_products_name ON products(name)")
-    cur.execute("CREATE INDEX IF NOT EXISTS idx_sales_sold_at ON sales(sold_at)")
+    # Leads with the range column and covers the summed columns, so the totals/top-product
+    # aggregates are answered from the index without touching the table
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_sales_ts_covering ON sales(sold_at_ts, product_id, qty, unit_cost, total)")
     cur.execute("CREATE INDEX IF NOT EXISTS idx_sales_invoice ON sales(invoice)")
     cur.execute("CREATE INDEX IF NOT EXISTS idx_stock_adjustments_product_id ON stock_adjustments(product_id)")
-    cur.execute("CREATE INDEX IF NOT EXISTS idx_stock_adjustments_adjusted_at ON stock_adjustments(adjusted_at)")
-    conn.commit()
-
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_stock_adjustments_ts ON stock_adjustments(adjusted_at_ts)")
+    # Compound indexes matching the date-range + product filters and low-stock checks
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_sales_product_ts ON sales(product_id, sold_at_ts)")
+    # Date filters use the epoch columns now, so the original TEXT timestamp indexes are unused
+    cur.execute("DROP INDEX IF EXISTS idx_sales_sold_at")
+    cur.execute("DROP INDEX IF EXISTS idx_stock_adjustments_adjusted_at")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_products_category_id ON products(category_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_products_reorder ON products(quantity, reorder_level)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_products_expiry ON products(expiry_date)")
+
+def _insert_samples(cur):
+    """Inserts the default admin, sample categories and sample products into whichever tables are empty."""
     # Insert default admin if no users exist
     cur.execute("SELECT COUNT(*) as cnt FROM users")
     if cur.fetchone()["cnt"] == 0:
-        pw_hash = bcrypt.hashpw(DEFAULT_ADMIN_PASSWORD.encode("utf-8"), bcrypt.gensalt())
+        pw_hash = hash_password(DEFAULT_ADMIN_PASSWORD)
         cur.execute(
             "INSERT INTO users (username, password_hash, full_name, role) VALUES (?, ?, ?, ?)",
             ("admin", pw_hash, "Administrator", "admin"),
         )
-        conn.commit()
-        print("Default admin created with username 'admin' and password from ADMIN_PASSWORD env variable or 'admin123'")
 
     # Insert sample categories if none exist
     cur.execute("SELECT COUNT(*) as cnt FROM categories")
     if cur.fetchone()["cnt"] == 0:
-        categories = [
-            ("Analgesics",), ("Antibiotics",), ("Antihistamines",), ("Antihypertensives",), ("Antidiabetics",),
-            ("Antidepressants",), ("Antianxiety Agents",), ("Antivirals",), ("Antifungals",), ("Antacids & GI Drugs",),
-            ("Cardiovascular Drugs",), ("Respiratory Drugs",), ("Vitamins & Supplements",), ("Hormonal Agents",),
-            ("Anticoagulants",), ("Anti-inflammatory Drugs",), ("Anticonvulsants",), ("Dermatologicals",),
-            ("Ophthalmic Drugs",), ("OTC Medications",),
-        ]
-        cur.executemany("INSERT INTO categories (name) VALUES (?)", categories)
-        conn.commit()
-        print("Inserted 20 sample categories")
-
-    # Get category IDs
-    cur.execute("SELECT id, name FROM categories")
-    category_map = {row["name"]: row["id"] for row in cur.fetchall()}
+        cur.executemany("INSERT INTO categories (name) VALUES (?)", _SEED_CATEGORIES)
 
     # Insert sample products if none exist
     cur.execute("SELECT COUNT(*) as cnt FROM products")
     if cur.fetchone()["cnt"] == 0:
-        products = [
-            # Analgesics (6 products)
-            ("Ibuprofen 200mg", category_map["Analgesics"], 100, 5.99, 3.50, 20, "Supplier A", "2026-12-31"),
-            ("Acetaminophen 500mg", category_map["Analgesics"], 150, 4.99, 2.80, 30, "Supplier B", "2026-11-15"),
-            ("Aspirin 325mg", category_map["Analgesics"], 80, 3.49, 2.00, 15, "Supplier A", "2027-03-20"),
-            ("Naproxen 250mg", category_map["Analgesics"], 60, 6.49, 3.90, 10, "Supplier C", "2026-09-10"),
-            ("Diclofenac Gel 1%", category_map["Analgesics"], 40, 12.99, 8.00, 10, "Supplier B", "2027-01-05"),
-            ("Paracetamol 650mg", category_map["Analgesics"], 120, 5.49, 3.20, 25, "Supplier A", "2026-10-30"),
-            # Antibiotics (6 products)
-            ("Amoxicillin 500mg", category_map["Antibiotics"], 50, 8.99, 5.50, 10, "Supplier D", "2026-08-25"),
-            ("Azithromycin 250mg", category_map["Antibiotics"], 30, 10.99, 6.80, 5, "Supplier E", "2026-07-15"),
-            ("Ciprofloxacin 500mg", category_map["Antibiotics"], 40, 12.49, 7.50, 10, "Supplier D", "2026-12-10"),
-            ("Doxycycline 100mg", category_map["Antibiotics"], 60, 9.99, 6.00, 15, "Supplier E", "2027-02-28"),
-            ("Clindamycin 300mg", category_map["Antibiotics"], 25, 15.99, 9.50, 5, "Supplier D", "2026-11-30"),
-            ("Erythromycin 500mg", category_map["Antibiotics"], 35, 11.49, 7.00, 10, "Supplier E", "2026-09-30"),
-            # Antihistamines (6 products)
-            ("Cetirizine 10mg", category_map["Antihistamines"], 80, 6.49, 3.80, 15, "Supplier F", "2026-10-10"),
-            ("Loratadine 10mg", category_map["Antihistamines"], 100, 5.99, 3.50, 20, "Supplier F", "2027-03-05"),
-            ("Fexofenadine 180mg", category_map["Antihistamines"], 60, 9.99, 6.00, 10, "Supplier G", "2026-11-25"),
-            ("Diphenhydramine 25mg", category_map["Antihistamines"], 70, 4.99, 2.90, 15, "Supplier F", "2026-09-20"),
-            ("Chlorpheniramine 4mg", category_map["Antihistamines"], 50, 3.99, 2.30, 10, "Supplier G", "2027-02-15"),
-            ("Desloratadine 5mg", category_map["Antihistamines"], 40, 10.49, 6.30, 10, "Supplier F", "2026-12-20"),
-            # Antihypertensives (4 products)
-            ("Lisinopril 10mg", category_map["Antihypertensives"], 90, 6.99, 4.20, 20, "Supplier H", "2026-10-20"),
-            ("Amlodipine 5mg", category_map["Antihypertensives"], 100, 8.49, 5.10, 20, "Supplier H", "2027-01-25"),
-            ("Losartan 50mg", category_map["Antihypertensives"], 60, 9.49, 5.70, 15, "Supplier I", "2027-03-10"),
-            ("Hydrochlorothiazide 25mg", category_map["Antihypertensives"], 80, 5.49, 3.30, 15, "Supplier H", "2026-12-05"),
-            # Antidiabetics (3 products)
-            ("Metformin 500mg", category_map["Antidiabetics"], 100, 7.99, 4.80, 20, "Supplier J", "2027-02-15"),
-            ("Glipizide 5mg", category_map["Antidiabetics"], 70, 6.99, 4.20, 15, "Supplier J", "2026-11-30"),
-            ("Insulin Glargine 100U/mL", category_map["Antidiabetics"], 20, 49.99, 30.00, 5, "Supplier K", "2026-09-15"),
-            # Antidepressants (3 products)
-            ("Sertraline 50mg", category_map["Antidepressants"], 50, 9.99, 6.00, 10, "Supplier L", "2027-01-10"),
-            ("Fluoxetine 20mg", category_map["Antidepressants"], 60, 8.49, 5.10, 10, "Supplier L", "2026-12-20"),
-            ("Escitalopram 10mg", category_map["Antidepressants"], 40, 10.99, 6.60, 10, "Supplier M", "2027-03-05"),
-            # Antianxiety Agents (2 products)
-            ("Lorazepam 1mg", category_map["Antianxiety Agents"], 30, 11.99, 7.20, 5, "Supplier N", "2026-10-15"),
-            ("Alprazolam 0.5mg", category_map["Antianxiety Agents"], 25, 12.49, 7.50, 5, "Supplier N", "2026-11-10"),
-            # Antivirals (2 products)
-            ("Oseltamivir 75mg", category_map["Antivirals"], 20, 29.99, 18.00, 5, "Supplier O", "2026-08-30"),
-            ("Acyclovir 400mg", category_map["Antivirals"], 30, 14.99, 9.00, 5, "Supplier O", "2026-12-10"),
-            # Antifungals (2 products)
-            ("Fluconazole 150mg", category_map["Antifungals"], 25, 15.99, 9.60, 5, "Supplier P", "2026-11-25"),
-            ("Clotrimazole Cream 1%", category_map["Antifungals"], 50, 7.99, 4.80, 10, "Supplier P", "2027-02-20"),
-            # Antacids & GI Drugs (2 products)
-            ("Omeprazole 20mg", category_map["Antacids & GI Drugs"], 60, 8.99, 5.40, 15, "Supplier Q", "2027-01-15"),
-            ("Loperamide 2mg", category_map["Antacids & GI Drugs"], 80, 4.99, 3.00, 20, "Supplier Q", "2026-10-30"),
-            # Cardiovascular Drugs (3 products)
-            ("Atenolol 50mg", category_map["Cardiovascular Drugs"], 70, 7.99, 4.80, 15, "Supplier R", "2027-04-15"),
-            ("Simvastatin 20mg", category_map["Cardiovascular Drugs"], 50, 8.99, 5.40, 10, "Supplier R", "2026-11-20"),
-            ("Clopidogrel 75mg", category_map["Cardiovascular Drugs"], 60, 10.49, 6.30, 10, "Supplier S", "2027-03-10"),
-            # Respiratory Drugs (2 products)
-            ("Albuterol Inhaler 90mcg", category_map["Respiratory Drugs"], 30, 24.99, 15.00, 5, "Supplier T", "2026-09-30"),
-            ("Montelukast 10mg", category_map["Respiratory Drugs"], 50, 9.99, 6.00, 10, "Supplier T", "2027-02-28"),
-            # Vitamins & Supplements (6 products)
-            ("Vitamin C 1000mg", category_map["Vitamins & Supplements"], 200, 4.99, 2.90, 30, "Supplier U", "2027-06-30"),
-            ("Vitamin D3 2000IU", category_map["Vitamins & Supplements"], 180, 5.49, 3.20, 25, "Supplier U", "2027-05-15"),
-            ("Multivitamin Tablets", category_map["Vitamins & Supplements"], 150, 6.99, 4.10, 20, "Supplier V", "2027-04-20"),
-            ("Vitamin B12 500mcg", category_map["Vitamins & Supplements"], 120, 5.99, 3.50, 20, "Supplier U", "2026-12-15"),
-            ("Omega-3 Fish Oil 1000mg", category_map["Vitamins & Supplements"], 100, 8.99, 5.30, 15, "Supplier V", "2027-02-10"),
-            ("Calcium 600mg + D3", category_map["Vitamins & Supplements"], 90, 7.49, 4.40, 15, "Supplier U", "2027-01-30"),
-            # Hormonal Agents (2 products)
-            ("Levothyroxine 100mcg", category_map["Hormonal Agents"], 60, 9.49, 5.70, 10, "Supplier W", "2027-03-15"),
-            ("Ethinyl Estradiol 0.03mg", category_map["Hormonal Agents"], 40, 12.99, 7.80, 10, "Supplier W", "2026-12-10"),
-            # Anticoagulants (2 products)
-            ("Warfarin 5mg", category_map["Anticoagulants"], 50, 8.49, 5.10, 10, "Supplier X", "2027-01-20"),
-            ("Apixaban 5mg", category_map["Anticoagulants"], 30, 19.99, 12.00, 5, "Supplier X", "2026-11-30"),
-            # Anti-inflammatory Drugs (2 products)
-            ("Prednisone 10mg", category_map["Anti-inflammatory Drugs"], 60, 6.99, 4.20, 10, "Supplier Y", "2026-10-25"),
-            ("Celecoxib 200mg", category_map["Anti-inflammatory Drugs"], 40, 13.99, 8.40, 10, "Supplier Y", "2027-02-10"),
-            # Anticonvulsants (2 products)
-            ("Gabapentin 300mg", category_map["Anticonvulsants"], 50, 10.99, 6.60, 10, "Supplier Z", "2026-12-15"),
-            ("Levetiracetam 500mg", category_map["Anticonvulsants"], 40, 12.49, 7.50, 10, "Supplier Z", "2027-01-30"),
-            # Dermatologicals (2 products)
-            ("Hydrocortisone Cream 1%", category_map["Dermatologicals"], 50, 6.99, 4.20, 10, "Supplier AA", "2027-02-25"),
-            ("Mupirocin Ointment 2%", category_map["Dermatologicals"], 30, 11.99, 7.20, 5, "Supplier AA", "2026-11-15"),
-            # Ophthalmic Drugs (2 products)
-            ("Artificial Tears 0.5%", category_map["Ophthalmic Drugs"], 60, 5.99, 3.60, 10, "Supplier BB", "2027-03-20"),
-            ("Timolol Eye Drops 0.5%", category_map["Ophthalmic Drugs"], 25, 14.99, 9.00, 5, "Supplier BB", "2026-12-05"),
-            # OTC Medications (2 products)
-            ("Loperamide 2mg", category_map["OTC Medications"], 80, 4.99, 3.00, 20, "Supplier CC", "2026-10-30"),
-            ("Acetaminophen 500mg", category_map["OTC Medications"], 150, 4.99, 2.80, 30, "Supplier CC", "2026-11-15"),
-        ]
         cur.executemany(
-            "INSERT OR IGNORE INTO products (name, category_id, quantity, price, cost, reorder_level, supplier, expiry_date) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-            products
+            "INSERT OR IGNORE INTO products (name, category_id, quantity, price, cost, reorder_level, supplier, expiry_date) "
+            "VALUES (?, (SELECT id FROM categories WHERE name = ?), ?, ?, ?, ?, ?, ?)",
+            _SEED_PRODUCTS
         )
-        conn.commit()
-        print("Inserted 51 sample products")
 
 # ---------- AUTH HELPERS ----------
 def hash_password(password: str) -> bytes:
     """Hashes a password using bcrypt."""
-    return bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt())
+    return bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt(rounds=BCRYPT_ROUNDS))
 
 def _ensure_bytes(pw_hash: Any) -> bytes:
     """Converts a password hash from memoryview or str to bytes."""
@@ -245,24 +454,78 @@ def _ensure_bytes(pw_hash: Any) -> bytes:
         return pw_hash.encode("utf-8")
     return pw_hash
 
+@st.cache_resource
+def _verified_passwords() -> tuple:
+    """Process-wide cache of successful (sha256(password), stored hash) verifications, with its lock.
+
+    Sessions run on separate threads, so every read, eviction and insert holds the lock.
+    """
+    return threading.Lock(), {}
+
 def check_password(password: str, pw_hash: Any) -> bool:
-    """Checks a plain-text password against a hashed password."""
+    """Checks a plain-text password against a hashed password.
+
+    Successful checks are remembered by SHA-256 digest of the password (never the plain text) and
+    stored hash, so repeat checks skip bcrypt; failed checks always pay the full bcrypt cost.
+    """
+    b = _ensure_bytes(pw_hash)
+    key = (hashlib.sha256(password.encode("utf-8")).digest(), b)
+    lock, verified = _verified_passwords()
+    with lock:
+        if key in verified:
+            return True
     try:
-        b = _ensure_bytes(pw_hash)
-        return bcrypt.checkpw(password.encode("utf-8"), b)
-    except Exception:
+        if not bcrypt.checkpw(password.encode("utf-8"), b):
+            return False
+    except (ValueError, TypeError):
+        # Malformed or missing stored hash
         return False
+    with lock:
+        if len(verified) >= 256:
+            del verified[next(iter(verified))]
+        verified[key] = True
+    return True
 
 # ---------- DB CRUD (IMPROVED) ----------
+def _epoch(dt: datetime) -> int:
+    """Seconds since the epoch for a naive datetime, read as UTC to match SQLite's strftime('%s', text)."""
+    return calendar.timegm(dt.timetuple())
+
+def _epoch_range(date_from: str, date_to: str) -> tuple:
+    """Converts an inclusive YYYY-MM-DD range to [date_from, day after date_to) epoch bounds.
+
+    Compared against the integer *_ts columns, which range-seek on their indexes.
+    """
+    start = date.fromisoformat(date_from)
+    end = date.fromisoformat(date_to) + timedelta(days=1)
+    return calendar.timegm(start.timetuple()), calendar.timegm(end.timetuple())
+
+def _query_df(conn, sql: str, params: tuple = (), dtype: Optional[Dict[str, str]] = None) -> pd.DataFrame:
+    """Runs a query and builds a DataFrame straight from the fetched tuples and cursor.description."""
+    cur = conn.cursor()
+    cur.row_factory = None  # plain tuples; sqlite3.Row objects are not needed here
+    cur.execute(sql, params)
+    df = pd.DataFrame(cur.fetchall(), columns=[d[0] for d in cur.description])
+    return df.astype(dtype) if dtype else df
+
+def _query_duck_df(duck, sql: str, params: tuple = ()) -> pd.DataFrame:
+    """Runs a query on the DuckDB analytics connection and converts its columnar result to a DataFrame."""
+    # A cursor is a separate DuckDB connection to the same database, safe to use from this thread
+    with closing(duck.cursor()) as cur:
+        return cur.execute(sql, list(params)).df()
+
 def get_user_by_username(conn, username: str):
     """Fetches a single user by username."""
     cur = conn.cursor()
     cur.execute("SELECT * FROM users WHERE username=?", (username.strip(),))
     return cur.fetchone()
 
+_ROLE_DTYPE = pd.CategoricalDtype(["staff", "admin"])
+
 def list_users(conn) -> pd.DataFrame:
-    """Lists all users (excluding password hash)."""
-    return pd.read_sql_query("SELECT id, username, full_name, role, created_at FROM users ORDER BY username", conn)
+    """Lists all users (excluding password hash); role is a staff/admin categorical."""
+    df = _query_df(conn, "SELECT id, username, full_name, role, created_at FROM users ORDER BY username")
+    return df.astype({"role": _ROLE_DTYPE})
 
 def add_user(conn, username: str, password: str, full_name: str = "", role: str = "staff") -> bool:
     """Adds a new user to the database."""
@@ -276,6 +539,7 @@ def add_user(conn, username: str, password: str, full_name: str = "", role: str
         cur.execute("INSERT INTO users (username, password_hash, full_name, role) VALUES (?, ?, ?, ?)",
                     (username.strip(), pw_hash, full_name.strip(), role))
         conn.commit()
+        bump_revision("users")
         return True
     except sqlite3.IntegrityError as e:
         if "UNIQUE constraint failed" in str(e):
@@ -302,30 +566,31 @@ def update_user(conn, user_id: int, full_name: str, role: str):
     if cur.rowcount == 0:
         raise ValueError("User ID not found.")
     conn.commit()
+    bump_revision("users")
 
 def delete_user(conn, user_id: int):
     """Deletes a user. Anonymizes associated sales and adjustments by setting references to NULL to preserve history."""
     cur = conn.cursor()
-    
-    # Anonymize sales records
-    cur.execute("UPDATE sales SET sold_by = NULL WHERE sold_by = ?", (user_id,))
-    sales_updated = cur.rowcount
-    
-    # Anonymize stock adjustments
-    cur.execute("UPDATE stock_adjustments SET adjusted_by = NULL WHERE adjusted_by = ?", (user_id,))
-    adjustments_updated = cur.rowcount
+    with immediate(conn):
+        # Anonymize sales records
+        cur.execute("UPDATE sales SET sold_by = NULL WHERE sold_by = ?", (user_id,))
+        sales_updated = cur.rowcount
+
+        # Anonymize stock adjustments
+        cur.execute("UPDATE stock_adjustments SET adjusted_by = NULL WHERE adjusted_by = ?", (user_id,))
+        adjustments_updated = cur.rowcount
+
+        # Now delete the user
+        cur.execute("DELETE FROM users WHERE id=?", (user_id,))
+        if cur.rowcount == 0:
+            raise ValueError("User ID not found.")
+    bump_revision("users", "sales")
 
-    # Now delete the user
-    cur.execute("DELETE FROM users WHERE id=?", (user_id,))
-    if cur.rowcount == 0:
-        raise ValueError("User ID not found.")
-    conn.commit()
-    
     print(f"User deleted. Anonymized {sales_updated} sales and {adjustments_updated} stock adjustments.")
 
 def list_categories(conn) -> pd.DataFrame:
     """Lists all product categories."""
-    return pd.read_sql_query("SELECT * FROM categories ORDER BY name", conn)
+    return _query_df(conn, "SELECT * FROM categories ORDER BY name")
 
 def add_category(conn, name: str) -> bool:
     """Adds a new category."""
@@ -335,6 +600,7 @@ def add_category(conn, name: str) -> bool:
         cur = conn.cursor()
         cur.execute("INSERT INTO categories (name) VALUES (?)", (name.strip(),))
         conn.commit()
+        bump_revision("categories")
         return True
     except sqlite3.IntegrityError as e:
         if "UNIQUE constraint failed" in str(e):
@@ -351,19 +617,21 @@ def update_category(conn, category_id: int, new_name: str):
         if cur.rowcount == 0:
             raise ValueError("Category ID not found.")
         conn.commit()
+        bump_revision("categories")
     except sqlite3.IntegrityError:
         raise ValueError(f"Category '{new_name}' already exists.")
 
 def delete_category(conn, category_id: int):
     """Deletes a category, fails if products are associated."""
     cur = conn.cursor()
-    cur.execute("SELECT COUNT(*) as cnt FROM products WHERE category_id=?", (category_id,))
-    if cur.fetchone()["cnt"] > 0:
-        raise ValueError("Cannot delete category with associated products. Reassign or delete associated products first.")
-    cur.execute("DELETE FROM categories WHERE id=?", (category_id,))
-    if cur.rowcount == 0:
-        raise ValueError("Category ID not found.")
-    conn.commit()
+    with immediate(conn):
+        cur.execute("SELECT COUNT(*) as cnt FROM products WHERE category_id=?", (category_id,))
+        if cur.fetchone()["cnt"] > 0:
+            raise ValueError("Cannot delete category with associated products. Reassign or delete associated products first.")
+        cur.execute("DELETE FROM categories WHERE id=?", (category_id,))
+        if cur.rowcount == 0:
+            raise ValueError("Category ID not found.")
+    bump_revision("categories")
 
 def get_product(conn, product_id: int):
     """Fetches a single product by ID."""
@@ -371,15 +639,52 @@ def get_product(conn, product_id: int):
     cur.execute("SELECT * FROM products WHERE id=?", (product_id,))
     return cur.fetchone()
 
+_PRODUCT_DTYPES = {
+    "quantity": "int32", "reorder_level": "int32", "low_stock": "bool",
+    "supplier": "category", "category_name": "category",
+}
+
 def get_products(conn) -> pd.DataFrame:
-    """Lists all products with their category name."""
-    q = """
-    SELECT p.*, c.name as category_name
-    FROM products p
-    LEFT JOIN categories c ON p.category_id=c.id
-    ORDER BY p.name
-    """
-    return pd.read_sql_query(q, conn)
+    """Lists all products with their category name, low-stock flag and days to expiry (see v_products_enriched)."""
+    q = "SELECT * FROM v_products_enriched ORDER BY name"
+    return _query_df(conn, q, dtype=_PRODUCT_DTYPES)
+
+def search_products(conn, text: str) -> pd.DataFrame:
+    """Products whose name or supplier contains text (case-insensitive LIKE), with the same columns as get_products."""
+    pattern = _like_pattern(text)
+    q = "SELECT * FROM v_products_enriched WHERE name LIKE ? ESCAPE '\\' OR supplier LIKE ? ESCAPE '\\' ORDER BY name"
+    return _query_df(conn, q, (pattern, pattern), dtype=_PRODUCT_DTYPES)
+
+# adjusted_at defaults to CURRENT_TIMESTAMP (UTC); adjusted_at_ts is the same instant as an epoch
+_INSERT_ADJUSTMENT_SQL = (
+    "INSERT INTO stock_adjustments (product_id, adjustment_qty, reason, adjusted_by, adjusted_at_ts) "
+    "VALUES (?, ?, ?, ?, CAST(strftime('%s', 'now') AS INTEGER))"
+)
+
+# Alert lists shown page by page on the dashboard: (filter, sort) over v_products_enriched
+_LOW_STOCK_FILTER = "quantity <= reorder_level"
+_NEAR_EXPIRY_FILTER = "expiry_date <= date('now', 'localtime', '+30 days') AND days_to_expiry IS NOT NULL"
+_ALERT_COLUMNS = "id, name, quantity, reorder_level, supplier, category_name, expiry_date, price, cost"
+
+def _products_page(conn, where: str, page: int, page_size: Optional[int]) -> tuple:
+    """One page of products matching where, ordered by name, plus the total match count."""
+    cur = conn.cursor()
+    cur.execute(f"SELECT COUNT(*) FROM v_products_enriched WHERE {where}")
+    total = cur.fetchone()[0]
+    limit = -1 if page_size is None else page_size  # LIMIT -1: no limit
+    offset = 0 if page_size is None else (page - 1) * page_size
+    q = f"SELECT {_ALERT_COLUMNS} FROM v_products_enriched WHERE {where} ORDER BY name LIMIT ? OFFSET ?"
+    df = _query_df(conn, q, (limit, offset), dtype={"quantity": "int32", "reorder_level": "int32"})
+    df["expiry_date"] = pd.to_datetime(df["expiry_date"], errors="coerce")
+    return df, total
+
+def get_low_stock_page(conn, page: int = 1, page_size: Optional[int] = 10) -> tuple:
+    """Products at or below their reorder level, paginated in SQL (page_size=None for all); returns (df, total)."""
+    return _products_page(conn, _LOW_STOCK_FILTER, page, page_size)
+
+def get_near_expiry_page(conn, page: int = 1, page_size: Optional[int] = 10) -> tuple:
+    """Products expiring within 30 days, paginated in SQL (page_size=None for all); returns (df, total)."""
+    return _products_page(conn, _NEAR_EXPIRY_FILTER, page, page_size)
 
 def add_product(conn, name: str, category_id: Optional[int], quantity: int, price: float, cost: float, reorder_level: int, supplier: str, expiry_date: Optional[str] = None) -> int:
     """Adds a new product and records the initial stock as a stock adjustment."""
@@ -392,7 +697,7 @@ def add_product(conn, name: str, category_id: Optional[int], quantity: int, pric
 
     cur = conn.cursor()
     try:
-        with conn:
+        with immediate(conn):
             cur.execute(
                 "INSERT INTO products (name, category_id, quantity, price, cost, reorder_level, supplier, expiry_date) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
                 (name.strip(), category_id, quantity, price, cost, reorder_level, supplier.strip() or None, expiry_date),
@@ -402,9 +707,10 @@ def add_product(conn, name: str, category_id: Optional[int], quantity: int, pric
             # Record initial stock as an adjustment
             if quantity > 0:
                 cur.execute(
-                    "INSERT INTO stock_adjustments (product_id, adjustment_qty, reason, adjusted_by) VALUES (?, ?, ?, ?)",
+                    _INSERT_ADJUSTMENT_SQL,
                     (product_id, quantity, "Initial Stock Entry", None),
                 )
+        bump_revision("products")
         return product_id
     except sqlite3.IntegrityError as e:
         raise ValueError(f"Database error during product add: {e}")
@@ -419,16 +725,16 @@ def update_product(conn, product_id: int, name: str, category_id: Optional[int],
         raise TypeError("Category ID must be an integer or None")
 
     cur = conn.cursor()
-    # 1. Get current product data
-    row = get_product(conn, product_id)
-    if row is None:
-        raise ValueError(f"Product with ID {product_id} not found.")
-    current_quantity = row["quantity"]
-    
-    # 2. Calculate adjustment needed
-    adjustment_qty = new_quantity - current_quantity
-    
-    with conn:
+    with immediate(conn):
+        # 1. Get current product data
+        row = get_product(conn, product_id)
+        if row is None:
+            raise ValueError(f"Product with ID {product_id} not found.")
+        current_quantity = row["quantity"]
+
+        # 2. Calculate adjustment needed
+        adjustment_qty = new_quantity - current_quantity
+
         # Final plan: Update all fields (including quantity), then log the delta as an adjustment.
         cur.execute(
             "UPDATE products SET name=?, category_id=?, price=?, cost=?, quantity=?, reorder_level=?, supplier=?, expiry_date=? WHERE id=?",
@@ -439,28 +745,28 @@ def update_product(conn, product_id: int, name: str, category_id: Optional[int],
         if adjustment_qty != 0:
             # Log the adjustment
             cur.execute(
-                "INSERT INTO stock_adjustments (product_id, adjustment_qty, reason, adjusted_by) VALUES (?, ?, ?, ?)",
+                _INSERT_ADJUSTMENT_SQL,
                 (product_id, adjustment_qty, f"Manual Edit/Correction (New Qty: {new_quantity})", adjusted_by),
             )
-    conn.commit()
-
+    bump_revision("products")
 
 def delete_product(conn, product_id: int):
     """Deletes a product, fails if associated sales exist (to maintain history). Automatically cleans up stock adjustments if no sales."""
     cur = conn.cursor()
-    # Check for sales (hard block for integrity)
-    cur.execute("SELECT COUNT(*) as cnt FROM sales WHERE product_id=?", (product_id,))
-    if cur.fetchone()["cnt"] > 0:
-        raise ValueError("Cannot delete product with associated sales history.")
-    
-    # If no sales, safely delete any stock adjustments first (e.g., initial entry for new products)
-    cur.execute("DELETE FROM stock_adjustments WHERE product_id=?", (product_id,))
-    
-    # Now delete the product
-    cur.execute("DELETE FROM products WHERE id=?", (product_id,))
-    if cur.rowcount == 0:
-        raise ValueError("Product ID not found.")
-    conn.commit()
+    with immediate(conn):
+        # Check for sales (hard block for integrity)
+        cur.execute("SELECT COUNT(*) as cnt FROM sales WHERE product_id=?", (product_id,))
+        if cur.fetchone()["cnt"] > 0:
+            raise ValueError("Cannot delete product with associated sales history.")
+
+        # If no sales, safely delete any stock adjustments first (e.g., initial entry for new products)
+        cur.execute("DELETE FROM stock_adjustments WHERE product_id=?", (product_id,))
+
+        # Now delete the product
+        cur.execute("DELETE FROM products WHERE id=?", (product_id,))
+        if cur.rowcount == 0:
+            raise ValueError("Product ID not found.")
+    bump_revision("products")
 
 def adjust_stock(conn, product_id: int, adj_qty: int, reason: str, adjusted_by: Optional[int] = None):
     """Adjusts product stock and records the adjustment."""
@@ -470,22 +776,23 @@ def adjust_stock(conn, product_id: int, adj_qty: int, reason: str, adjusted_by:
         raise ValueError("Reason for adjustment is required")
     
     cur = conn.cursor()
-    row = get_product(conn, product_id)
-    if row is None:
-        raise ValueError("Product not found")
-        
-    current_qty = row["quantity"]
-    new_qty = current_qty + adj_qty
-    
-    if new_qty < 0:
-        raise ValueError(f"Cannot adjust stock below zero (current: {current_qty}, adjustment: {adj_qty})")
-        
-    with conn:
+    with immediate(conn):
+        row = get_product(conn, product_id)
+        if row is None:
+            raise ValueError("Product not found")
+
+        current_qty = row["quantity"]
+        new_qty = current_qty + adj_qty
+
+        if new_qty < 0:
+            raise ValueError(f"Cannot adjust stock below zero (current: {current_qty}, adjustment: {adj_qty})")
+
         cur.execute("UPDATE products SET quantity = ? WHERE id=?", (new_qty, product_id))
         cur.execute(
-            "INSERT INTO stock_adjustments (product_id, adjustment_qty, reason, adjusted_by) VALUES (?, ?, ?, ?)",
+            _INSERT_ADJUSTMENT_SQL,
             (product_id, adj_qty, reason.strip(), adjusted_by),
         )
+    bump_revision("products")
 
 def get_stock_adjustments(conn, product_id: Optional[int] = None, date_from: Optional[str] = None, date_to: Optional[str] = None) -> pd.DataFrame:
     """Retrieves stock adjustment history."""
@@ -501,127 +808,188 @@ def get_stock_adjustments(conn, product_id: Optional[int] = None, date_from: Opt
         where_clauses.append("sa.product_id = ?")
         params.append(product_id)
     if date_from and date_to:
-        where_clauses.append("date(sa.adjusted_at) BETWEEN ? AND ?")
-        params.extend([date_from, date_to])
+        where_clauses.append("sa.adjusted_at_ts >= ? AND sa.adjusted_at_ts < ?")
+        params.extend(_epoch_range(date_from, date_to))
     if where_clauses:
         q += " WHERE " + " AND ".join(where_clauses)
-    q += " ORDER BY sa.adjusted_at DESC"
-    return pd.read_sql_query(q, conn, params=tuple(params))
+    q += " ORDER BY sa.adjusted_at_ts DESC, sa.id DESC"
+    return _query_df(conn, q, tuple(params))
 
-def generate_invoice(conn) -> str:
-    """Generate a sequential invoice number for the current day."""
+def _allocate_invoice(cur) -> str:
+    """Takes the next sequential invoice number for the current day; the caller owns the transaction.
+
+    The day's counter in invoice_counters is seeded from existing sales the first time the day is
+    seen, then incremented atomically so two checkouts never receive the same number.
+    """
     today_str = date.today().strftime("%y%m%d")  # YYMMDD format
-    cur = conn.cursor()
-    like_pattern = f"INV-{today_str}-%"
-    cur.execute("SELECT COUNT(DISTINCT invoice) FROM sales WHERE invoice LIKE ?", (like_pattern,))
-    count = cur.fetchone()[0] + 1
+    cur.execute(
+        """
+        INSERT OR IGNORE INTO invoice_counters (day, last_seq)
+        SELECT ?, COUNT(DISTINCT invoice) FROM sales
+        WHERE invoice LIKE ? AND NOT EXISTS (SELECT 1 FROM invoice_counters WHERE day = ?)
+        """,
+        (today_str, f"INV-{today_str}-%", today_str),
+    )
+    cur.execute("UPDATE invoice_counters SET last_seq = last_seq + 1 WHERE day = ? RETURNING last_seq", (today_str,))
+    count = cur.fetchone()[0]
     return f"INV-{today_str}-{count:03d}"
 
-def record_sale(conn, invoice: str, items: List[Dict[str, Any]], sold_by: Optional[int] = None) -> float:
-    """Record multiple sale items under a single invoice in a transaction."""
-    cur = conn.cursor()
-    totals = []
-    
+def generate_invoice(conn) -> str:
+    """Allocate the next sequential invoice number for the current day in its own transaction."""
+    with immediate(conn):
+        return _allocate_invoice(conn.cursor())
+
+def _line_errors(items: List[Dict[str, Any]], mask: np.ndarray, message: str, stocks: Optional[np.ndarray] = None) -> List[str]:
+    """Formats message for every cart line flagged in mask, once per distinct text."""
+    errors = [
+        message.format(
+            name=items[i].get('product_name', 'Unknown'),
+            product_id=items[i]["product_id"],
+            stock=None if stocks is None else stocks[i],
+        )
+        for i in np.flatnonzero(mask)
+    ]
+    return list(dict.fromkeys(errors))
+
+def record_sale(conn, invoice: Optional[str], items: List[Dict[str, Any]], sold_by: Optional[int] = None) -> tuple:
+    """Record multiple sale items under a single invoice in a transaction; returns (invoice, total).
+
+    Every line is validated up front with array masks (one error listing all bad lines), stock
+    with one query, then all sale rows and stock decrements are written with one executemany each.
+    A blank invoice is allocated inside the same transaction, so a rejected sale consumes no number.
+    """
     if not items:
         raise ValueError("Cannot record an empty sale.")
 
-    try:
-        # Start transaction
-        with conn:
-            for item in items:
-                product_id = item["product_id"]
-                qty = item["qty"]
-                unit_price = item["unit_price"]
-                unit_cost = item["unit_cost"]
-                
-                # 'discount' is the per-unit discount amount from the cart logic
-                per_unit_discount = round(item["discount"], 2) 
-                final_total = round(qty * (unit_price - per_unit_discount), 2)
-                
-                if qty <= 0:
-                    raise ValueError(f"Quantity must be positive for {item.get('product_name', 'Unknown')}")
-                if final_total < 0:
-                    raise ValueError(f"Total sale amount cannot be negative for {item.get('product_name', 'Unknown')}")
-
-                # Validate stock
-                cur.execute("SELECT quantity FROM products WHERE id=?", (product_id,))
-                row = cur.fetchone()
-                if row is None:
-                    raise ValueError(f"Product ID {product_id} not found")
-                avail = row["quantity"]
-                if qty > avail:
-                    raise ValueError(f"Only {avail} units available for {item.get('product_name', 'Unknown')}")
-
-                # Insert sale record (FIXED: This was the source of the SyntaxError)
-                cur.execute(
-                    """
-                    INSERT INTO sales (invoice, product_id, qty, unit_price, unit_cost, discount, total, sold_by, sold_at)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-                    """,
-                    (invoice, product_id, qty, unit_price, unit_cost, per_unit_discount, final_total, sold_by, datetime.now().isoformat()),
-                )
+    # Line arithmetic and rounding for the whole cart in one vectorized pass
+    # ('discount' is the per-unit discount amount from the cart logic)
+    arr = np.array([(item["qty"], item["unit_price"], item["discount"]) for item in items], dtype=np.float64)
+    per_unit_discounts = np.round(arr[:, 2], 2)
+    totals = np.round(arr[:, 0] * (arr[:, 1] - per_unit_discounts), 2)
+    errors = _line_errors(items, arr[:, 0] <= 0, "Quantity must be positive for {name}")
+    errors += _line_errors(items, totals < 0, "Total sale amount cannot be negative for {name}")
+    if errors:
+        raise ValueError("; ".join(errors))
+
+    product_ids = np.array([int(item["product_id"]) for item in items], dtype=np.int64)
+    now = datetime.now()
+    sold_at, sold_at_ts = now.isoformat(), _epoch(now)
+    line_rows = []  # sale rows without the invoice, which may only be known inside the transaction
+    requested: Dict[int, int] = {}  # product_id -> total qty across lines
+    for item, product_id, per_unit_discount, final_total in zip(items, product_ids.tolist(), per_unit_discounts.tolist(), totals.tolist()):
+        qty = item["qty"]
+        requested[product_id] = requested.get(product_id, 0) + qty
+        line_rows.append((product_id, qty, item["unit_price"], item["unit_cost"], per_unit_discount, final_total, sold_by, sold_at, sold_at_ts))
 
-                # Update stock
-                cur.execute("UPDATE products SET quantity = quantity - ? WHERE id=?", (qty, product_id))
-                totals.append(final_total)
-    except Exception as e:
-        conn.rollback()
-        raise e
-    return sum(totals)
+    cur = conn.cursor()
+    # Start transaction (rolled back by immediate() on any error)
+    with immediate(conn):
+        # Validate stock for all products at once
+        # Fixed SQL text (ids passed as one JSON array) so the prepared statement is reused
+        cur.execute("SELECT id, quantity FROM products WHERE id IN (SELECT value FROM json_each(?))", (json.dumps(list(requested)),))
+        available = {row["id"]: row["quantity"] for row in cur.fetchall()}
+        stocks = np.array([available.get(pid, -1) for pid in product_ids.tolist()], dtype=np.int64)  # -1: not found
+        wanted = np.array([requested[pid] for pid in product_ids.tolist()], dtype=np.int64)
+        missing = stocks < 0
+        errors = _line_errors(items, missing, "Product ID {product_id} not found")
+        errors += _line_errors(items, ~missing & (wanted > stocks), "Only {stock} units available for {name}", stocks)
+        if errors:
+            raise ValueError("; ".join(errors))
+
+        invoice = invoice or _allocate_invoice(cur)
+        cur.executemany(
+            """
+            INSERT INTO sales (invoice, product_id, qty, unit_price, unit_cost, discount, total, sold_by, sold_at, sold_at_ts)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            [(invoice, *row) for row in line_rows],
+        )
+        cur.executemany("UPDATE products SET quantity = quantity - ? WHERE id=?", [(qty, pid) for pid, qty in requested.items()])
+    bump_revision("products", "sales")
+    return invoice, sum(row[5] for row in line_rows)
 
 def undo_sale(conn, invoice: str, sold_by: Optional[int] = None):
     """Reverses a sale by invoice number, restoring stock."""
     cur = conn.cursor()
-    # Fetch sales items for the invoice
-    cur.execute(
-        """
-        SELECT product_id, qty
-        FROM sales
-        WHERE invoice = ?
-        """,
-        (invoice,)
-    )
-    sales = cur.fetchall()
-    if not sales:
-        raise ValueError(f"No sales found for invoice {invoice}")
-    
-    with conn:
-        # Restore stock for each item
-        for sale in sales:
-            product_id = sale["product_id"]
-            qty = sale["qty"]
-            cur.execute("UPDATE products SET quantity = quantity + ? WHERE id=?", (qty, product_id))
-        
+    with immediate(conn):
+        # Restore stock for every product on the invoice in one statement
+        cur.execute(
+            """
+            UPDATE products
+            SET quantity = quantity + (SELECT SUM(s.qty) FROM sales s WHERE s.invoice = ? AND s.product_id = products.id)
+            WHERE id IN (SELECT product_id FROM sales WHERE invoice = ?)
+            """,
+            (invoice, invoice),
+        )
+
         # Delete sale records
         cur.execute("DELETE FROM sales WHERE invoice = ?", (invoice,))
         if cur.rowcount == 0:
-            raise ValueError(f"Sale deletion failed for invoice {invoice}. This should not happen.")
-    conn.commit()
-
-def get_sales(conn, date_from: Optional[str] = None, date_to: Optional[str] = None, product_id: Optional[int] = None, invoice: Optional[str] = None) -> pd.DataFrame:
-    """Retrieves sales data with profit calculation."""
-    q = """
-    SELECT s.id, s.invoice, s.product_id, s.qty, s.unit_price, s.unit_cost, s.discount, s.total, s.sold_by, s.sold_at,
-           p.name as product_name, u.username as sold_by_username
+            raise ValueError(f"No sales found for invoice {invoice}")
+    bump_revision("products", "sales")
+
+# Column layout and dtypes of get_sales, applied to every result (empty or not, SQLite or DuckDB) so
+# the frame's types never depend on its contents: int32 quantities, categorical repeated names,
+# nullable sold_by (deleted users are NULL) and float64 money
+_SALES_DTYPES = {
+    'id': 'int64', 'invoice': 'str', 'product_id': 'int64', 'qty': 'int32',
+    'unit_price': 'float64', 'unit_cost': 'float64', 'discount': 'float64', 'total': 'float64',
+    'sold_by': 'Int64', 'sold_at': 'datetime64[us]', 'product_name': 'category', 'sold_by_username': 'category',
+    'total_cost': 'float64', 'profit': 'float64',
+}
+
+# Built once for empty results; categoricals start from str like the non-empty name columns
+_EMPTY_SALES = pd.DataFrame({
+    column: pd.Series(dtype='str' if dtype == 'category' else dtype) for column, dtype in _SALES_DTYPES.items()
+}).astype(_SALES_DTYPES)
+
+def _base_sales_query(columns: str) -> str:
+    """SELECT columns over sales s joined with its product p and seller u (LEFT JOINs, so deleted ones are kept)."""
+    return f"""
+    SELECT {columns}
     FROM sales s
     LEFT JOIN products p ON s.product_id = p.id
     LEFT JOIN users u ON s.sold_by = u.id
     """
-    params = []
+
+def _sales_sql(has_dates: bool, has_product: bool, has_invoice: bool, has_search: bool) -> str:
+    """get_sales' SQL for one combination of filters; parameters bind in date, product, invoice, search order."""
+    q = _base_sales_query(
+        "s.id, s.invoice, s.product_id, s.qty, s.unit_price, s.unit_cost, s.discount, s.total, s.sold_by, s.sold_at, "
+        "p.name as product_name, u.username as sold_by_username"
+    )
     where_clauses = []
-    if date_from and date_to:
-        where_clauses.append("date(s.sold_at) BETWEEN ? AND ?")
-        params.extend([date_from, date_to])
-    if product_id is not None:
+    if has_dates:
+        where_clauses.append("s.sold_at_ts >= ? AND s.sold_at_ts < ?")
+    if has_product:
         where_clauses.append("s.product_id = ?")
-        params.append(product_id)
-    if invoice:
+    if has_invoice:
         where_clauses.append("s.invoice = ?")
-        params.append(invoice)
+    if has_search:
+        where_clauses.append("(p.name LIKE ? ESCAPE '\\' OR s.invoice LIKE ? ESCAPE '\\')")
     if where_clauses:
         q += " WHERE " + " AND ".join(where_clauses)
-    q += " ORDER BY s.sold_at DESC"
-    df = pd.read_sql_query(q, conn, params=tuple(params))
+    return q + " ORDER BY s.sold_at_ts DESC, s.id DESC"
+
+# Every get_sales filter combination, built once so each call reuses identical SQL text
+# (and therefore the connection's cached prepared statement)
+_SALES_SQL = {flags: _sales_sql(*flags) for flags in itertools.product((False, True), repeat=4)}
+
+def get_sales(conn, date_from: Optional[str] = None, date_to: Optional[str] = None, product_id: Optional[int] = None, invoice: Optional[str] = None, search: Optional[str] = None) -> pd.DataFrame:
+    """Retrieves sales data with profit calculation.
+
+    When search is given only lines whose product name or invoice contains it are returned.
+    """
+    has_dates = bool(date_from and date_to)
+    params: List[Any] = list(_epoch_range(date_from, date_to)) if has_dates else []
+    if product_id is not None:
+        params.append(product_id)
+    if invoice:
+        params.append(invoice)
+    if search:
+        params.extend([_like_pattern(search)] * 2)
+    q = _SALES_SQL[(has_dates, product_id is not None, bool(invoice), bool(search))]
+    df = _query_df(conn, q, tuple(params))
     if not df.empty:
         # Profit calculation: total_revenue - total_cost
         # s.total is the revenue after per-unit discount
@@ -629,11 +997,303 @@ def get_sales(conn, date_from: Optional[str] = None, date_to: Optional[str] = No
         df['total_cost'] = df['qty'] * df['unit_cost']
         df['profit'] = df['total'] - df['total_cost']
         df['sold_at'] = pd.to_datetime(df['sold_at'], errors='coerce')
+        df = df.astype(_SALES_DTYPES)
     else:
-        # Ensure consistent column structure for empty dataframes
-        df = pd.DataFrame(columns=['id', 'invoice', 'product_id', 'qty', 'unit_price', 'unit_cost', 'discount', 'total', 'sold_by', 'sold_at', 'product_name', 'sold_by_username', 'total_cost', 'profit'])
+        # Consistent, typed column structure for empty results; the shared frame is never mutated
+        df = _EMPTY_SALES.copy(deep=False)
+    return df
+
+def get_recent_sales(conn, date_from: str, date_to: str, limit: int = 10) -> pd.DataFrame:
+    """The latest limit sale lines in the date range, with profit; only those rows are read."""
+    q = _base_sales_query(
+        "s.invoice, p.name AS product_name, s.qty, s.unit_price, s.discount, s.total, "
+        "s.total - s.qty * s.unit_cost AS profit, s.sold_at, u.username AS sold_by_username"
+    ) + " WHERE s.sold_at_ts >= ? AND s.sold_at_ts < ? ORDER BY s.sold_at_ts DESC, s.id DESC LIMIT ?"
+    df = _query_df(conn, q, (*_epoch_range(date_from, date_to), limit))
+    df['sold_at'] = pd.to_datetime(df['sold_at'], errors='coerce')
+    return df
+
+def get_sales_analytics(duck, date_from: Optional[str] = None, date_to: Optional[str] = None) -> pd.DataFrame:
+    """DuckDB version of get_sales (same columns); sold_at is cast to TIMESTAMP and profit computed in SQL."""
+    q = """
+    SELECT s.id, s.invoice, s.product_id, s.qty, s.unit_price, s.unit_cost, s.discount, s.total, s.sold_by,
+           TRY_CAST(s.sold_at AS TIMESTAMP) AS sold_at,
+           p.name AS product_name, u.username AS sold_by_username,
+           s.qty * s.unit_cost AS total_cost,
+           s.total - s.qty * s.unit_cost AS profit
+    FROM pharm.sales s
+    LEFT JOIN pharm.products p ON s.product_id = p.id
+    LEFT JOIN pharm.users u ON s.sold_by = u.id
+    """
+    params: tuple = ()
+    if date_from and date_to:
+        q += " WHERE s.sold_at_ts >= ? AND s.sold_at_ts < ?"
+        params = _epoch_range(date_from, date_to)
+    q += " ORDER BY s.sold_at_ts DESC, s.id DESC"
+    return _query_duck_df(duck, q, params).astype(_SALES_DTYPES)
+
+def _like_pattern(text: str) -> str:
+    """Builds a LIKE pattern matching text anywhere, escaping LIKE wildcards (use with ESCAPE '\\')."""
+    escaped = text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
+
+def get_sales_daily(conn, date_from: str, date_to: str) -> pd.DataFrame:
+    """Per-day revenue, profit and order count, aggregated in SQL."""
+    q = """
+    SELECT date(sold_at) AS day,
+           SUM(total) AS total,
+           SUM(total - qty * unit_cost) AS profit,
+           COUNT(DISTINCT invoice) AS orders
+    FROM sales
+    WHERE sold_at_ts >= ? AND sold_at_ts < ?
+    GROUP BY 1
+    ORDER BY 1
+    """
+    return _query_df(conn, q, _epoch_range(date_from, date_to))
+
+def get_sales_daily_analytics(duck, date_from: str, date_to: str) -> pd.DataFrame:
+    """DuckDB version of get_sales_daily, scanning the attached SQLite sales table column-wise."""
+    q = """
+    SELECT left(sold_at, 10) AS day,
+           SUM(total)::DOUBLE AS total,
+           SUM(total - qty * unit_cost)::DOUBLE AS profit,
+           COUNT(DISTINCT invoice) AS orders
+    FROM pharm.sales
+    WHERE sold_at_ts >= ? AND sold_at_ts < ?
+    GROUP BY 1
+    ORDER BY 1
+    """
+    return _query_duck_df(duck, q, _epoch_range(date_from, date_to))
+
+def get_sales_totals(conn, date_from: str, date_to: str) -> tuple:
+    """Total revenue and profit over the date range, summed in SQL."""
+    cur = conn.cursor()
+    cur.execute(
+        """
+        SELECT COALESCE(SUM(total), 0), COALESCE(SUM(total - qty * unit_cost), 0)
+        FROM sales
+        WHERE sold_at_ts >= ? AND sold_at_ts < ?
+        """,
+        _epoch_range(date_from, date_to),
+    )
+    return tuple(cur.fetchone())
+
+def get_top_products(conn, date_from: str, date_to: str, n: int = 5) -> pd.DataFrame:
+    """The n best-selling products by revenue over the date range, with units sold and profit."""
+    q = _base_sales_query(
+        "p.name AS product_name, SUM(s.qty) AS qty, SUM(s.total) AS total, SUM(s.total - s.qty * s.unit_cost) AS profit"
+    ) + " WHERE s.sold_at_ts >= ? AND s.sold_at_ts < ? GROUP BY s.product_id ORDER BY total DESC LIMIT ?"
+    return _query_df(conn, q, (*_epoch_range(date_from, date_to), n))
+
+def get_top_products_analytics(duck, date_from: str, date_to: str, n: int = 5) -> pd.DataFrame:
+    """DuckDB version of get_top_products, scanning the attached SQLite tables column-wise."""
+    q = """
+    SELECT p.name AS product_name,
+           SUM(s.qty)::BIGINT AS qty,
+           SUM(s.total)::DOUBLE AS total,
+           SUM(s.total - s.qty * s.unit_cost)::DOUBLE AS profit
+    FROM pharm.sales s
+    LEFT JOIN pharm.products p ON s.product_id = p.id
+    WHERE s.sold_at_ts >= ? AND s.sold_at_ts < ?
+    GROUP BY s.product_id, p.name
+    ORDER BY total DESC
+    LIMIT ?
+    """
+    return _query_duck_df(duck, q, (*_epoch_range(date_from, date_to), n))
+
+def get_sales_by_category(conn, date_from: str, date_to: str) -> pd.DataFrame:
+    """Revenue per category over the date range; categories without sales are left out."""
+    q = """
+    SELECT c.name AS category_name, SUM(s.total) AS total
+    FROM sales s
+    JOIN products p ON s.product_id = p.id
+    JOIN categories c ON p.category_id = c.id
+    WHERE s.sold_at_ts >= ? AND s.sold_at_ts < ?
+    GROUP BY c.id
+    HAVING SUM(s.total) > 0
+    ORDER BY total DESC
+    """
+    return _query_df(conn, q, _epoch_range(date_from, date_to))
+
+def get_sales_by_category_analytics(duck, date_from: str, date_to: str) -> pd.DataFrame:
+    """DuckDB version of get_sales_by_category, scanning the attached SQLite tables column-wise."""
+    q = """
+    SELECT c.name AS category_name, SUM(s.total)::DOUBLE AS total
+    FROM pharm.sales s
+    JOIN pharm.products p ON s.product_id = p.id
+    JOIN pharm.categories c ON p.category_id = c.id
+    WHERE s.sold_at_ts >= ? AND s.sold_at_ts < ?
+    GROUP BY c.id, c.name
+    HAVING SUM(s.total) > 0
+    ORDER BY total DESC
+    """
+    return _query_duck_df(duck, q, _epoch_range(date_from, date_to))
+
+def get_sales_by_invoice(conn, date_from: str, date_to: str, search: Optional[str] = None) -> pd.DataFrame:
+    """One row per invoice (items, total, sale time, seller), aggregated in SQL, newest first.
+
+    When search is given only line items whose product name or invoice contains it are included.
+    """
+    q = _base_sales_query(
+        "s.invoice, GROUP_CONCAT(p.name, ' | ') AS items, SUM(s.total) AS total, "
+        "MAX(s.sold_at) AS sold_at, MAX(u.username) AS sold_by_username"
+    ) + " WHERE s.sold_at_ts >= ? AND s.sold_at_ts < ?"
+    params: List[Any] = list(_epoch_range(date_from, date_to))
+    if search:
+        q += " AND (p.name LIKE ? ESCAPE '\\' OR s.invoice LIKE ? ESCAPE '\\')"
+        params.extend([_like_pattern(search)] * 2)
+    q += " GROUP BY s.invoice ORDER BY sold_at DESC"
+    df = _query_df(conn, q, tuple(params))
+    df['sold_at'] = pd.to_datetime(df['sold_at'], errors='coerce')
     return df
 
+# ---------- CACHED READS ----------
+# Served from st.cache_data until one of the tables in the key is modified (see bump_revision).
+@st.cache_data(ttl=300, show_spinner=False)
+def _cached_get_products(rev: tuple) -> pd.DataFrame:
+    with get_pool().read() as conn:
+        return get_products(conn)
+
+def cached_get_products() -> pd.DataFrame:
+    """Cached get_products; invalidated by product and category writes and at midnight.
+
+    The frame is also kept in session_state under its revision, so reruns with no catalog change
+    reuse the same object instead of unpickling a fresh copy; callers must not modify it.
+    The key includes today's date because days_to_expiry is relative to the current day.
+    """
+    rev = (*revision_key("products", "categories"), date.today().isoformat())
+    memo = st.session_state.get("_prod_df")
+    if memo is None or memo[0] != rev:
+        memo = (rev, _cached_get_products(rev))
+        st.session_state["_prod_df"] = memo
+    return memo[1]
+
+@st.cache_data(ttl=300, show_spinner=False)
+def _cached_search_products(rev: tuple, text: str) -> pd.DataFrame:
+    with get_pool().read() as conn:
+        return search_products(conn, text)
+
+def cached_search_products(text: str) -> pd.DataFrame:
+    """Cached search_products; invalidated by product and category writes."""
+    return _cached_search_products(revision_key("products", "categories"), text)
+
+@st.cache_data(ttl=300, show_spinner=False)
+def _cached_get_low_stock_page(rev: tuple, page: int, page_size: Optional[int]) -> tuple:
+    with get_pool().read() as conn:
+        return get_low_stock_page(conn, page, page_size)
+
+def cached_get_low_stock_page(page: int = 1, page_size: Optional[int] = 10) -> tuple:
+    """Cached get_low_stock_page; invalidated by product and category writes."""
+    return _cached_get_low_stock_page(revision_key("products", "categories"), page, page_size)
+
+@st.cache_data(ttl=300, show_spinner=False)
+def _cached_get_near_expiry_page(rev: tuple, page: int, page_size: Optional[int]) -> tuple:
+    with get_pool().read() as conn:
+        return get_near_expiry_page(conn, page, page_size)
+
+def cached_get_near_expiry_page(page: int = 1, page_size: Optional[int] = 10) -> tuple:
+    """Cached get_near_expiry_page; invalidated by product and category writes."""
+    return _cached_get_near_expiry_page(revision_key("products", "categories"), page, page_size)
+
+@st.cache_data(ttl=300, show_spinner=False)
+def _cached_list_categories(rev: tuple) -> pd.DataFrame:
+    with get_pool().read() as conn:
+        return list_categories(conn)
+
+def cached_list_categories() -> pd.DataFrame:
+    """Cached list_categories; invalidated by category writes."""
+    return _cached_list_categories(revision_key("categories"))
+
+@st.cache_data(ttl=300, show_spinner=False)
+def _cached_list_users(rev: tuple) -> pd.DataFrame:
+    with get_pool().read() as conn:
+        return list_users(conn)
+
+def cached_list_users() -> pd.DataFrame:
+    """Cached list_users; invalidated by user writes."""
+    return _cached_list_users(revision_key("users"))
+
+@st.cache_data(ttl=300, show_spinner=False)
+def _cached_get_sales(rev: tuple, date_from: Optional[str], date_to: Optional[str], product_id: Optional[int], invoice: Optional[str], search: Optional[str]) -> pd.DataFrame:
+    duck = get_analytics_conn()
+    if duck is not None and product_id is None and not invoice and not search:
+        return get_sales_analytics(duck, date_from, date_to)
+    with get_pool().read() as conn:
+        return get_sales(conn, date_from, date_to, product_id, invoice, search)
+
+def cached_get_sales(date_from: Any = None, date_to: Any = None, product_id: Optional[int] = None, invoice: Optional[str] = None, search: Optional[str] = None) -> pd.DataFrame:
+    """Cached get_sales; invalidated by sale, product and user writes (product/user names are joined in).
+
+    Dates may be date objects or YYYY-MM-DD strings; both map to the same cache entry.
+    """
+    date_from = date_from.isoformat() if isinstance(date_from, date) else date_from
+    date_to = date_to.isoformat() if isinstance(date_to, date) else date_to
+    product_id = int(product_id) if product_id is not None else None
+    return _cached_get_sales(revision_key("sales", "products", "users"), date_from, date_to, product_id, invoice or None, search or None)
+
+@st.cache_data(ttl=300, show_spinner=False)
+def _cached_get_recent_sales(rev: tuple, date_from: str, date_to: str, limit: int) -> pd.DataFrame:
+    with get_pool().read() as conn:
+        return get_recent_sales(conn, date_from, date_to, limit)
+
+def cached_get_recent_sales(date_from: str, date_to: str, limit: int = 10) -> pd.DataFrame:
+    """Cached get_recent_sales; invalidated by sale, product and user writes."""
+    return _cached_get_recent_sales(revision_key("sales", "products", "users"), date_from, date_to, limit)
+
+@st.cache_data(ttl=300, show_spinner=False)
+def _cached_get_sales_daily(rev: tuple, date_from: str, date_to: str) -> pd.DataFrame:
+    duck = get_analytics_conn()
+    if duck is not None:
+        return get_sales_daily_analytics(duck, date_from, date_to)
+    with get_pool().read() as conn:
+        return get_sales_daily(conn, date_from, date_to)
+
+def cached_get_sales_daily(date_from: str, date_to: str) -> pd.DataFrame:
+    """Cached get_sales_daily; invalidated by sale writes."""
+    return _cached_get_sales_daily(revision_key("sales"), date_from, date_to)
+
+@st.cache_data(ttl=300, show_spinner=False)
+def _cached_get_sales_totals(rev: tuple, date_from: str, date_to: str) -> tuple:
+    with get_pool().read() as conn:
+        return get_sales_totals(conn, date_from, date_to)
+
+def cached_get_sales_totals(date_from: str, date_to: str) -> tuple:
+    """Cached get_sales_totals; invalidated by sale writes."""
+    return _cached_get_sales_totals(revision_key("sales"), date_from, date_to)
+
+@st.cache_data(ttl=300, show_spinner=False)
+def _cached_get_top_products(rev: tuple, date_from: str, date_to: str, n: int) -> pd.DataFrame:
+    duck = get_analytics_conn()
+    if duck is not None:
+        return get_top_products_analytics(duck, date_from, date_to, n)
+    with get_pool().read() as conn:
+        return get_top_products(conn, date_from, date_to, n)
+
+def cached_get_top_products(date_from: str, date_to: str, n: int = 5) -> pd.DataFrame:
+    """Cached get_top_products; invalidated by sale and product writes."""
+    return _cached_get_top_products(revision_key("sales", "products"), date_from, date_to, n)
+
+@st.cache_data(ttl=300, show_spinner=False)
+def _cached_get_sales_by_category(rev: tuple, date_from: str, date_to: str) -> pd.DataFrame:
+    duck = get_analytics_conn()
+    if duck is not None:
+        return get_sales_by_category_analytics(duck, date_from, date_to)
+    with get_pool().read() as conn:
+        return get_sales_by_category(conn, date_from, date_to)
+
+def cached_get_sales_by_category(date_from: str, date_to: str) -> pd.DataFrame:
+    """Cached get_sales_by_category; invalidated by sale, product and category writes."""
+    return _cached_get_sales_by_category(revision_key("sales", "products", "categories"), date_from, date_to)
+
+@st.cache_data(ttl=300, show_spinner=False)
+def _cached_get_sales_by_invoice(rev: tuple, date_from: str, date_to: str, search: Optional[str]) -> pd.DataFrame:
+    with get_pool().read() as conn:
+        return get_sales_by_invoice(conn, date_from, date_to, search)
+
+def cached_get_sales_by_invoice(date_from: str, date_to: str, search: Optional[str] = None) -> pd.DataFrame:
+    """Cached get_sales_by_invoice; invalidated by sale, product and user writes."""
+    return _cached_get_sales_by_invoice(revision_key("sales", "products", "users"), date_from, date_to, search)
+
 # ---------- UI HELPERS ----------
 def format_currency(x: Any) -> str:
     """Formats a number as a currency string."""
@@ -642,22 +1302,42 @@ def format_currency(x: Any) -> str:
     except Exception:
         return str(x)
 
+@st.cache_data(show_spinner=False, max_entries=32)
+def _csv_bytes(df_key: tuple, _df: pd.DataFrame) -> bytes:
+    return _df.to_csv(index=False).encode("utf-8")
+
 def dataframe_to_csv_bytes(df: pd.DataFrame) -> bytes:
-    """Converts a pandas DataFrame to CSV bytes."""
-    return df.to_csv(index=False).encode("utf-8")
+    """Converts a pandas DataFrame to CSV bytes, reusing the bytes of an identical earlier frame.
+
+    The key hashes every row in order (plus columns and dtypes), which is much cheaper than to_csv.
+    """
+    row_hashes = pd.util.hash_pandas_object(df, index=False).to_numpy()
+    df_key = (tuple(df.columns), tuple(df.dtypes.astype(str)), hashlib.sha1(row_hashes.tobytes()).hexdigest())
+    return _csv_bytes(df_key, df)
 
 # ---------- AUTH UI (Unchanged) ----------
-def login_area(conn):
+def _admin_uses_default_password(row) -> bool:
+    """Whether the admin row still has the default password; bcrypt runs once per session per stored hash."""
+    key = (row["id"], row["password_hash"])
+    if st.session_state.get("_admin_default_check_key") != key:
+        st.session_state["_admin_default_check"] = check_password(DEFAULT_ADMIN_PASSWORD, row["password_hash"])
+        st.session_state["_admin_default_check_key"] = key
+    return st.session_state["_admin_default_check"]
+
+def login_area(pool):
     st.sidebar.header("🔐 Login")
     if "user" in st.session_state and st.session_state["user"]:
         st.sidebar.write(f"Signed in as **{st.session_state['user']['username']}** ({st.session_state['user']['role']})")
-        row = get_user_by_username(conn, "admin")
-        if st.session_state["user"]["username"] == "admin" and row and check_password(DEFAULT_ADMIN_PASSWORD, row["password_hash"]):
-            st.sidebar.warning("Please change the default admin password in the Users section.")
+        if st.session_state["user"]["username"] == "admin":
+            with pool.read() as conn:
+                row = get_user_by_username(conn, "admin")
+            if row and _admin_uses_default_password(row):
+                st.sidebar.warning("Please change the default admin password in the Users section.")
         if st.sidebar.button("Sign out"):
             st.session_state.pop("user", None)
             st.session_state.pop("page", None)
             st.session_state.pop("cart", None)
+            st.session_state.pop("cart_display_cache", None)
             st.session_state.pop("last_sale", None)
             st.rerun()
         return True
@@ -668,11 +1348,13 @@ def login_area(conn):
         if not username or not password:
             st.sidebar.error("Username and password are required")
             return False
-        row = get_user_by_username(conn, username)
+        with pool.read() as conn:
+            row = get_user_by_username(conn, username)
         if row:
             if check_password(password, row["password_hash"]):
                 st.session_state["user"] = {"id": row["id"], "username": row["username"], "full_name": row["full_name"], "role": row["role"]}
-                st.session_state["cart"] = []
+                st.session_state["cart"] = {}
+                st.session_state.pop("cart_display_cache", None)
                 st.session_state["last_sale"] = None
                 st.sidebar.success(f"Welcome, {row['username']}")
                 st.rerun()
@@ -684,7 +1366,7 @@ def login_area(conn):
     return False
 
 # ---------- APP CONTENT (Minor UI tweaks for clarity/RBAC) ----------
-def dashboard_page(conn):
+def dashboard_page(pool):
     st.header("📊 Dashboard")
     feedback_container = st.container()
     page_size = 10
@@ -706,50 +1388,44 @@ def dashboard_page(conn):
         d_to = st.date_input("Sales To", value=today, key="metrics_sales_to")
 
     # Metrics
-    prod_df = get_products(conn)
-    prod_df['expiry_date'] = pd.to_datetime(prod_df['expiry_date'], errors='coerce')
-    sales_df = get_sales(conn, d_from.isoformat(), d_to.isoformat())
-    low_stock = prod_df[prod_df["quantity"] <= prod_df["reorder_level"]]
-    critical_stock = prod_df[prod_df["quantity"] <= prod_df["reorder_level"] * 0.1]
-    near_expiry = prod_df[(prod_df['expiry_date'] <= datetime.now() + timedelta(days=30)) & (prod_df['expiry_date'].notnull())]
-    critical_expiry = prod_df[(prod_df['expiry_date'] <= datetime.now() + timedelta(days=7)) & (prod_df['expiry_date'].notnull())]
-    total_sales = sales_df["total"].sum() if not sales_df.empty else 0
-    total_profit = sales_df["profit"].sum() if not sales_df.empty else 0
+    prod_df = cached_get_products()
+    recent_sales = cached_get_recent_sales(d_from.isoformat(), d_to.isoformat(), 10)
+    # Critical stock/expiry are only counted, from boolean masks over the cached product list
+    # Whole days from today, computed once in the view; NaN when there is no expiry date
+    days_left = prod_df["days_to_expiry"].to_numpy(dtype=np.float64)
+    critical_stock_count = int((prod_df["quantity"].to_numpy() <= prod_df["reorder_level"].to_numpy() * 0.1).sum())
+    critical_expiry_count = int((days_left <= 7).sum())
+    # Low-stock and near-expiry lists are paginated in SQL; the page widgets below keep their value in session_state
+    low_stock_paginated, low_stock_total = cached_get_low_stock_page(st.session_state.get("low_stock_page", 1), page_size)
+    near_expiry_paginated, near_expiry_total = cached_get_near_expiry_page(st.session_state.get("near_expiry_page", 1), page_size)
+    total_sales, total_profit = cached_get_sales_totals(d_from.isoformat(), d_to.isoformat())
     total_inventory_value = (prod_df['quantity'] * prod_df['cost']).sum()
 
-    # Merge for category sales
-    sales_with_cat = sales_df.merge(prod_df[['id', 'category_name']], left_on='product_id', right_on='id', how='left')
-
     # Alerts for critical issues
-    if not critical_expiry.empty or not critical_stock.empty:
+    if critical_expiry_count or critical_stock_count:
         with feedback_container:
-            if not critical_expiry.empty:
-                st.error(f"⚠️ **CRITICAL:** {len(critical_expiry)} product(s) expiring within 7 days!")
-            if not critical_stock.empty:
-                st.error(f"⚠️ **CRITICAL:** {len(critical_stock)} product(s) critically low (≤10% of reorder level)!")
+            if critical_expiry_count:
+                st.error(f"⚠️ **CRITICAL:** {critical_expiry_count} product(s) expiring within 7 days!")
+            if critical_stock_count:
+                st.error(f"⚠️ **CRITICAL:** {critical_stock_count} product(s) critically low (≤10% of reorder level)!")
 
     # Key Metrics - Added inventory value
     st.subheader("Key Metrics")
     col1, col2, col3, col4, col5, col6 = st.columns(6)
-    col1.metric("Low Stock Items", len(low_stock), delta_color="inverse")
-    col2.metric("Critical Stock Items", len(critical_stock), delta_color="inverse")
-    col3.metric("Near Expiry Items", len(near_expiry), delta_color="inverse")
+    col1.metric("Low Stock Items", low_stock_total, delta_color="inverse")
+    col2.metric("Critical Stock Items", critical_stock_count, delta_color="inverse")
+    col3.metric("Near Expiry Items", near_expiry_total, delta_color="inverse")
     col4.metric(f"Sales ({d_from} to {d_to})", format_currency(total_sales))
     col5.metric(f"Profit ({d_from} to {d_to})", format_currency(total_profit))
     col6.metric("Total Inventory Value", format_currency(total_inventory_value))
 
     # Low Stock Items
     st.subheader("📦 Low Stock Items (≤ Reorder Level)")
-    if not low_stock.empty:
-        low_stock_display = low_stock[["id", "name", "quantity", "reorder_level", "supplier", "category_name", "expiry_date", "price", "cost"]].copy()
-        # Format columns
-        low_stock_display["price"] = low_stock_display["price"].apply(format_currency)
-        low_stock_display["cost"] = low_stock_display["cost"].apply(format_currency)
+    if low_stock_total:
         # Pagination
         page = st.number_input("Page", min_value=1, value=1, step=1, key="low_stock_page")
         start_idx = (page - 1) * page_size
         end_idx = start_idx + page_size
-        low_stock_paginated = low_stock_display.iloc[start_idx:end_idx]
         
         # Display Data Editor
         st.data_editor(
@@ -762,8 +1438,8 @@ def dashboard_page(conn):
                 "supplier": st.column_config.TextColumn("Supplier", disabled=True),
                 "category_name": st.column_config.TextColumn("Category", disabled=True),
                 "expiry_date": st.column_config.DateColumn("Expiry Date", disabled=True),
-                "price": st.column_config.TextColumn("Price", disabled=True),
-                "cost": st.column_config.TextColumn("Cost", disabled=True),
+                "price": st.column_config.NumberColumn("Price", format="$%.2f", disabled=True),
+                "cost": st.column_config.NumberColumn("Cost", format="$%.2f", disabled=True),
             },
             use_container_width=True,
             hide_index=True,
@@ -781,22 +1457,18 @@ def dashboard_page(conn):
                         st.session_state["page"] = "Products"
                         st.rerun()
 
-        st.write(f"Showing {start_idx + 1}–{min(end_idx, len(low_stock))} of {len(low_stock)} items")
-        csv_bytes = dataframe_to_csv_bytes(low_stock_display)
+        st.write(f"Showing {start_idx + 1}–{min(end_idx, low_stock_total)} of {low_stock_total} items")
+        csv_bytes = dataframe_to_csv_bytes(cached_get_low_stock_page(1, None)[0])
         st.download_button("📥 Export Low Stock CSV", csv_bytes, f"low_stock_{today}.csv", mime="text/csv")
     else:
         st.info("No low stock items.")
 
     # Near Expiry Items (Unchanged)
     st.subheader("⏰ Near Expiry Items (within 30 days)")
-    if not near_expiry.empty:
-        near_expiry_display = near_expiry[["id", "name", "quantity", "reorder_level", "supplier", "category_name", "expiry_date", "price", "cost"]].copy()
-        near_expiry_display["price"] = near_expiry_display["price"].apply(format_currency)
-        near_expiry_display["cost"] = near_expiry_display["cost"].apply(format_currency)
+    if near_expiry_total:
         page = st.number_input("Page", min_value=1, value=1, step=1, key="near_expiry_page")
         start_idx = (page - 1) * page_size
         end_idx = start_idx + page_size
-        near_expiry_paginated = near_expiry_display.iloc[start_idx:end_idx]
         st.data_editor(
             near_expiry_paginated,
             column_config={
@@ -807,15 +1479,15 @@ def dashboard_page(conn):
                 "supplier": st.column_config.TextColumn("Supplier", disabled=True),
                 "category_name": st.column_config.TextColumn("Category", disabled=True),
                 "expiry_date": st.column_config.DateColumn("Expiry Date", disabled=True),
-                "price": st.column_config.TextColumn("Price", disabled=True),
-                "cost": st.column_config.TextColumn("Cost", disabled=True)
+                "price": st.column_config.NumberColumn("Price", format="$%.2f", disabled=True),
+                "cost": st.column_config.NumberColumn("Cost", format="$%.2f", disabled=True)
             },
             use_container_width=True,
             hide_index=True,
             num_rows="fixed"
         )
-        st.write(f"Showing {start_idx + 1}–{min(end_idx, len(near_expiry))} of {len(near_expiry)} items")
-        csv_bytes = dataframe_to_csv_bytes(near_expiry_display)
+        st.write(f"Showing {start_idx + 1}–{min(end_idx, near_expiry_total)} of {near_expiry_total} items")
+        csv_bytes = dataframe_to_csv_bytes(cached_get_near_expiry_page(1, None)[0])
         st.download_button("📥 Export Near Expiry CSV", csv_bytes, f"near_expiry_{today}.csv", mime="text/csv")
     else:
         st.info("No near-expiry items.")
@@ -829,15 +1501,14 @@ def dashboard_page(conn):
         trend_to = st.date_input("To", value=today, key="sales_trend_to")
     with col3:
         metric = st.selectbox("Metric", ["Total Sales", "Profit"], key="sales_trend_metric")
-    sales_df_filtered = get_sales(conn, trend_from.isoformat(), trend_to.isoformat())
-    if not sales_df_filtered.empty:
-        sales_trend = sales_df_filtered.groupby(sales_df_filtered['sold_at'].dt.date)[['total', 'profit']].sum().reset_index()
+    sales_trend = cached_get_sales_daily(trend_from.isoformat(), trend_to.isoformat())
+    if not sales_trend.empty:
         y_field = 'total' if metric == "Total Sales" else 'profit'
         y_title = "Sales ($)" if metric == "Total Sales" else "Profit ($)"
         chart = alt.Chart(sales_trend).mark_bar().encode(
-            x=alt.X('sold_at:T', title='Date'),
+            x=alt.X('day:T', title='Date'),
             y=alt.Y(f'{y_field}:Q', title=y_title, axis=alt.Axis(format='$,.2f')),
-            tooltip=['sold_at:T', f'{y_field}:Q']
+            tooltip=['day:T', f'{y_field}:Q', 'orders:Q']
         ).properties(title=f"{metric} Trend")
         st.altair_chart(chart, use_container_width=True)
     else:
@@ -845,42 +1516,35 @@ def dashboard_page(conn):
 
     # New: Sales by Category Pie Chart
     st.subheader("📊 Sales by Category")
-    if not sales_df.empty and not sales_with_cat.empty:
-        cat_sales = sales_with_cat.groupby('category_name')['total'].sum().reset_index()
-        cat_sales = cat_sales[cat_sales['total'] > 0]  # Filter zero sales
-        if not cat_sales.empty:
-            pie = alt.Chart(cat_sales).mark_arc().encode(
-                theta=alt.Theta('total:Q'),
-                color=alt.Color('category_name:N', legend=alt.Legend(title='Category')),
-                tooltip=['category_name', alt.Tooltip('total:Q', format='$,.2f')]
-            ).properties(
-                title='Sales Distribution by Category',
-                width=400,
-                height=400
-            )
-            st.altair_chart(pie, use_container_width=True)
-        else:
-            st.info("No sales data available for categories.")
+    cat_sales = cached_get_sales_by_category(d_from.isoformat(), d_to.isoformat())
+    if not cat_sales.empty:
+        pie = alt.Chart(cat_sales).mark_arc().encode(
+            theta=alt.Theta('total:Q'),
+            color=alt.Color('category_name:N', legend=alt.Legend(title='Category')),
+            tooltip=['category_name', alt.Tooltip('total:Q', format='$,.2f')]
+        ).properties(
+            title='Sales Distribution by Category',
+            width=400,
+            height=400
+        )
+        st.altair_chart(pie, use_container_width=True)
+    elif not recent_sales.empty:
+        st.info("No sales data available for categories.")
     else:
         st.info("No sales data available.")
 
     st.subheader("Recent Sales (Latest 10)")
-    if not sales_df.empty:
-        sales_df_display = sales_df[["invoice", "product_name", "qty", "unit_price", "discount", "total", "profit", "sold_at", "sold_by_username"]].head(10).copy()
-        sales_df_display["unit_price"] = sales_df_display["unit_price"].apply(format_currency)
-        sales_df_display["discount"] = sales_df_display["discount"].apply(format_currency)
-        sales_df_display["total"] = sales_df_display["total"].apply(format_currency)
-        sales_df_display["profit"] = sales_df_display["profit"].apply(format_currency)
+    if not recent_sales.empty:
         edited_df = st.data_editor(
-            sales_df_display,
+            recent_sales,
             column_config={
                 "invoice": st.column_config.TextColumn("Invoice", disabled=True),
                 "product_name": st.column_config.TextColumn("Product", disabled=True),
                 "qty": st.column_config.NumberColumn("Quantity", disabled=True),
-                "unit_price": st.column_config.TextColumn("Unit Price", disabled=True),
-                "discount": st.column_config.TextColumn("Discount", disabled=True),
-                "total": st.column_config.TextColumn("Total", disabled=True),
-                "profit": st.column_config.TextColumn("Profit", disabled=True),
+                "unit_price": st.column_config.NumberColumn("Unit Price", format="$%.2f", disabled=True),
+                "discount": st.column_config.NumberColumn("Discount", format="$%.2f", disabled=True),
+                "total": st.column_config.NumberColumn("Total", format="$%.2f", disabled=True),
+                "profit": st.column_config.NumberColumn("Profit", format="$%.2f", disabled=True),
                 "sold_at": st.column_config.DatetimeColumn("Sold At", disabled=True),
                 "sold_by_username": st.column_config.TextColumn("Sold By", disabled=True),
             },
@@ -888,23 +1552,23 @@ def dashboard_page(conn):
             hide_index=True,
             num_rows="fixed"
         )
+        # The export covers the whole range, so only it reads the full sales lines
+        sales_df = cached_get_sales(d_from.isoformat(), d_to.isoformat())
         csv_bytes = dataframe_to_csv_bytes(sales_df[['invoice', 'product_name', 'qty', 'unit_price', 'discount', 'total', 'profit', 'sold_at', 'sold_by_username']])
         st.download_button("📥 Export Sales CSV", csv_bytes, f"sales_{d_from}_{d_to}.csv", mime="text/csv")
     else:
         st.info("No recent sales.")
 
     st.subheader("Top 5 Products by Sales")
-    if not sales_df.empty:
-        top_products = sales_df.groupby("product_name")[["qty", "total", "profit"]].sum().reset_index().sort_values("total", ascending=False).head(5)
-        top_products["total"] = top_products["total"].apply(format_currency)
-        top_products["profit"] = top_products["profit"].apply(format_currency)
+    top_products = cached_get_top_products(d_from.isoformat(), d_to.isoformat(), 5)
+    if not top_products.empty:
         st.data_editor(
             top_products,
             column_config={
                 "product_name": st.column_config.TextColumn("Product", disabled=True),
                 "qty": st.column_config.NumberColumn("Units Sold", disabled=True),
-                "total": st.column_config.TextColumn("Total Sales", disabled=True),
-                "profit": st.column_config.TextColumn("Total Profit", disabled=True)
+                "total": st.column_config.NumberColumn("Total Sales", format="$%.2f", disabled=True),
+                "profit": st.column_config.NumberColumn("Total Profit", format="$%.2f", disabled=True)
             },
             use_container_width=True,
             hide_index=True,
@@ -913,12 +1577,14 @@ def dashboard_page(conn):
     else:
         st.info("No sales data available.")
 
-def products_page(conn):
+def products_page(pool):
     st.header("📦 Products & Categories Management")
     
-    prod_df = get_products(conn)
-    cat_df = list_categories(conn)
-    cat_map = {row["name"]: row["id"] for _, row in cat_df.iterrows()} if not cat_df.empty else {}
+    prod_df = cached_get_products()
+    cat_df = cached_list_categories()
+    cat_map = dict(zip(cat_df["name"].tolist(), cat_df["id"].tolist())) if not cat_df.empty else {}
+    # list_categories is ordered by name, so cat_map's keys already come sorted
+    category_options = ["-- none --"] + list(cat_map)
     is_admin = st.session_state["user"]["role"] == "admin"
     
     # --- Tabs ---
@@ -931,7 +1597,6 @@ def products_page(conn):
             col1, col2 = st.columns(2)
             with col1:
                 name = st.text_input("Name", key="add_name")
-                category_options = ["-- none --"] + sorted(list(cat_map.keys()))
                 category = st.selectbox("Category", category_options, key="add_category")
                 supplier = st.text_input("Supplier", key="add_supplier")
             with col2:
@@ -945,7 +1610,8 @@ def products_page(conn):
                 try:
                     expiry_str = expiry.isoformat() if expiry else None
                     category_id = cat_map.get(category) if category != "-- none --" else None
-                    new_id = add_product(conn, name, category_id, int(qty), price, cost, int(reorder_level), supplier, expiry_str)
+                    with pool.write() as conn:
+                        new_id = add_product(conn, name, category_id, int(qty), price, cost, int(reorder_level), supplier, expiry_str)
                     st.success(f"Product added with ID {new_id}")
                     st.rerun()
                 except ValueError as e:
@@ -957,16 +1623,15 @@ def products_page(conn):
         st.subheader("Product List")
         q = st.text_input("Search products by name or supplier")
         
-        display_df = prod_df.copy()
-        
-        if q:
-            mask = display_df["name"].str.contains(q, case=False, na=False) | display_df["supplier"].str.contains(q, case=False, na=False)
-            display_df = display_df[mask]
-            
-        display_df["price"] = display_df["price"].apply(format_currency)
-        display_df["cost"] = display_df["cost"].apply(format_currency)
+        # Searching filters in SQL (LIKE is case-insensitive for ASCII); no search shows the cached list
+        display_df = cached_search_products(q) if q else prod_df
+
         st.data_editor(
             display_df[["id", "name", "quantity", "reorder_level", "supplier", "category_name", "price", "cost", "expiry_date"]],
+            column_config={
+                "price": st.column_config.NumberColumn("price", format="$%.2f"),
+                "cost": st.column_config.NumberColumn("cost", format="$%.2f"),
+            },
             use_container_width=True,
             hide_index=True,
             num_rows="dynamic"
@@ -974,7 +1639,7 @@ def products_page(conn):
 
         # --- Edit / delete ---
         st.subheader("✏️ Edit/ 🔴 Delete Product")
-        prod_options = {f'{r["name"]} (ID:{r["id"]}, Qty:{r["quantity"]})': r["id"] for _, r in prod_df.iterrows()} if not prod_df.empty else {}
+        prod_options = {f'{r.name} (ID:{r.id}, Qty:{r.quantity})': r.id for r in prod_df[["name", "id", "quantity"]].itertuples(index=False)}
         choice = st.selectbox("Select Product", ["-- select --"] + list(prod_options.keys()))
         if choice != "-- select --":
             pid = prod_options[choice]
@@ -990,7 +1655,6 @@ def products_page(conn):
                 col1, col2 = st.columns(2)
                 with col1:
                     name = st.text_input("Name", value=row["name"], disabled=not is_admin)
-                    category_options = ["-- none --"] + sorted(list(cat_map.keys()))
                     category_idx = 0
                     if row["category_id"] and row["category_name"]:
                         try:
@@ -998,7 +1662,7 @@ def products_page(conn):
                         except ValueError:
                             pass # Category name not in current list
                     category = st.selectbox("Category", category_options, index=category_idx, disabled=not is_admin)
-                    supplier = st.text_input("Supplier", value=row["supplier"] or "", disabled=not is_admin)
+                    supplier = st.text_input("Supplier", value=row["supplier"] if pd.notna(row["supplier"]) else "", disabled=not is_admin)
                     
                 with col2:
                     price = st.number_input("Price", value=float(row["price"]), format="%.2f", disabled=not is_admin)
@@ -1017,7 +1681,8 @@ def products_page(conn):
                         try:
                             expiry_str = expiry.isoformat() if expiry else None
                             category_id = cat_map.get(category) if category != "-- none --" else None
-                            update_product(conn, int(pid), name, category_id, price, cost, int(new_quantity), int(reorder_level), supplier, expiry_str, st.session_state["user"]["id"])
+                            with pool.write() as conn:
+                                update_product(conn, int(pid), name, category_id, price, cost, int(new_quantity), int(reorder_level), supplier, expiry_str, st.session_state["user"]["id"])
                             st.success("Product details updated")
                             st.rerun()
                         except ValueError as e:
@@ -1028,7 +1693,8 @@ def products_page(conn):
             if is_admin:
                 if st.button("🔴 Delete Product"):
                     try:
-                        delete_product(conn, pid)
+                        with pool.write() as conn:
+                            delete_product(conn, pid)
                         st.success("Product deleted")
                         st.rerun()
                     except ValueError as e:
@@ -1044,7 +1710,7 @@ def products_page(conn):
             st.error("You must be an Administrator to manage categories.")
             return
 
-        options = {f"{r['name']} (ID:{r['id']})": r["id"] for _, r in cat_df.iterrows()} if not cat_df.empty else {}
+        options = {f"{name} (ID:{cid})": cid for name, cid in zip(cat_df["name"].tolist(), cat_df["id"].tolist())}
         
         # --- Add Category ---
         st.subheader("➕ Add New Category")
@@ -1053,7 +1719,8 @@ def products_page(conn):
             submitted = st.form_submit_button("Add Category")
             if submitted:
                 try:
-                    ok = add_category(conn, new_cat_name)
+                    with pool.write() as conn:
+                        ok = add_category(conn, new_cat_name)
                     if ok:
                         st.success(f"Category '{new_cat_name}' added.")
                         st.rerun()
@@ -1077,7 +1744,7 @@ def products_page(conn):
         
         # --- EDIT/DELETE SECTION ---
         st.subheader("✏️ Edit/ 🔴 Delete Category")
-        edit_delete_choice = st.selectbox("Select Category", ["-- select --"] + sorted(list(options.keys())), key="edit_delete_cat_select")
+        edit_delete_choice = st.selectbox("Select Category", ["-- select --"] + list(options), key="edit_delete_cat_select")
         
         if edit_delete_choice != "-- select --":
             cat_id = options[edit_delete_choice]
@@ -1090,7 +1757,8 @@ def products_page(conn):
                     submitted = st.form_submit_button("Update Name")
                     if submitted:
                         try:
-                            update_category(conn, cat_id, new_name)
+                            with pool.write() as conn:
+                                update_category(conn, cat_id, new_name)
                             st.success(f"Category '{current_name}' successfully updated to '{new_name}'")
                             st.rerun()
                         except ValueError as e:
@@ -1102,7 +1770,8 @@ def products_page(conn):
                 st.warning("Deletion will fail if any products are currently assigned to this category. You must reassign or delete those products first.")
                 if st.button("Delete Category"):
                     try:
-                        delete_category(conn, cat_id)
+                        with pool.write() as conn:
+                            delete_category(conn, cat_id)
                         st.success("Category deleted")
                         st.rerun()
                     except ValueError as e:
@@ -1110,14 +1779,23 @@ def products_page(conn):
                     except Exception as e:
                         st.error(f"An unexpected error occurred: {e}")
 
-def users_page(conn):
+def users_page(pool):
     st.header("👥 Users")
     if st.session_state["user"]["role"] != "admin":
         st.error("Admin access required")
         st.stop()
         
     # List users
-    users_df = list_users(conn)
+    users_df = cached_list_users()
+    # Every user but the signed-in one, for the Edit and Delete tabs; each option carries the user's
+    # fields so a selection needs no second lookup in users_df
+    user_options = {
+        f"{username} ({full_name or 'N/A'} - {role})": (uid, username, full_name, role)
+        for uid, username, full_name, role in zip(
+            users_df["id"].tolist(), users_df["username"].tolist(), users_df["full_name"].tolist(), users_df["role"].tolist()
+        )
+        if uid != st.session_state["user"]["id"]
+    }
     st.subheader("User List")
     st.data_editor(
         users_df,
@@ -1156,7 +1834,8 @@ def users_page(conn):
                     st.error("Passwords do not match")
                 else:
                     try:
-                        ok = add_user(conn, username, password, full_name, role)
+                        with pool.write() as conn:
+                            ok = add_user(conn, username, password, full_name, role)
                         if ok:
                             st.success("User added")
                             st.rerun()
@@ -1167,22 +1846,21 @@ def users_page(conn):
     
     with tab2:
         st.markdown("### ✏️ Edit User")
-        options = {f"{r['username']} ({r['full_name'] or 'N/A'} - {r['role']})": r['id'] for _, r in users_df.iterrows() if r['id'] != st.session_state["user"]["id"]}
-        choice = st.selectbox("Select User to Edit", ["-- select --"] + list(options.keys()))
+        choice = st.selectbox("Select User to Edit", ["-- select --"] + list(user_options))
         if choice != "-- select --":
-            uid = options[choice]
-            user_row = users_df[users_df["id"] == uid].iloc[0]
+            uid, username, current_full_name, current_role = user_options[choice]
             with st.form("edit_user"):
                 col1, col2 = st.columns(2)
                 with col1:
-                    st.text_input("Username", value=user_row["username"], disabled=True)
+                    st.text_input("Username", value=username, disabled=True)
                 with col2:
-                    role = st.selectbox("Role", ["staff", "admin"], index=0 if user_row["role"] == "staff" else 1)
-                full_name = st.text_input("Full Name", value=user_row["full_name"] or "")
+                    role = st.selectbox("Role", ["staff", "admin"], index=0 if current_role == "staff" else 1)
+                full_name = st.text_input("Full Name", value=current_full_name or "")
                 submitted = st.form_submit_button("Update")
                 if submitted:
                     try:
-                        update_user(conn, uid, full_name, role)
+                        with pool.write() as conn:
+                            update_user(conn, uid, full_name, role)
                         st.success("User updated")
                         st.rerun()
                     except ValueError as e:
@@ -1192,7 +1870,10 @@ def users_page(conn):
     
     with tab3:
         st.markdown("### 🔑 Change Password")
-        options = {f"{r['username']} ({r['full_name'] or 'N/A'})": r['id'] for _, r in users_df.iterrows()}
+        options = {
+            f"{username} ({full_name or 'N/A'})": uid
+            for uid, username, full_name in zip(users_df["id"].tolist(), users_df["username"].tolist(), users_df["full_name"].tolist())
+        }
         choice = st.selectbox("Select User", ["-- select --"] + list(options.keys()))
         if choice != "-- select --":
             uid = options[choice]
@@ -1207,7 +1888,8 @@ def users_page(conn):
                         st.error("Password cannot be empty")
                     else:
                         try:
-                            change_user_password(conn, uid, new_pw)
+                            with pool.write() as conn:
+                                change_user_password(conn, uid, new_pw)
                             st.success("Password changed")
                             st.rerun()
                         except ValueError as e:
@@ -1217,15 +1899,14 @@ def users_page(conn):
     
     with tab4:
         st.markdown("### 🔴 Delete User")
-        options = {f"{r['username']} ({r['full_name'] or 'N/A'} - {r['role']})": r['id'] for _, r in users_df.iterrows() if r['id'] != st.session_state["user"]["id"]}
-        choice = st.selectbox("Select User to Delete", ["-- select --"] + list(options.keys()))
+        choice = st.selectbox("Select User to Delete", ["-- select --"] + list(user_options))
         if choice != "-- select --":
-            uid = options[choice]
-            user_row = users_df[users_df["id"] == uid].iloc[0]
-            st.warning(f"Deleting user '{user_row['username']}' ({user_row['role']}). This will anonymize their associated sales and stock adjustments (set to NULL) to preserve history, but cannot be undone.")
+            uid, username, _, role = user_options[choice]
+            st.warning(f"Deleting user '{username}' ({role}). This will anonymize their associated sales and stock adjustments (set to NULL) to preserve history, but cannot be undone.")
             if st.button("Confirm Delete", type="primary"):
                 try:
-                    delete_user(conn, uid)
+                    with pool.write() as conn:
+                        delete_user(conn, uid)
                     st.success("User deleted. Associated records anonymized.")
                     st.rerun()
                 except ValueError as e:
@@ -1233,15 +1914,164 @@ def users_page(conn):
                 except Exception as e:
                     st.error(f"An unexpected error occurred: {e}")
 
-def sales_page(conn):
+@st.fragment
+def _cart_section(pool):
+    """Cart editor, checkout and last receipt; editing the cart table reruns only this section."""
+    if st.session_state["cart"]:
+        st.subheader("🛒 Cart Summary")
+        
+        # Prepare display DataFrame; reruns that leave the cart unchanged reuse the last one.
+        # The key covers every field the frame is built from, so a different cart never hits it.
+        cart_key = tuple(
+            (item["product_id"], item["product_name"], item["unit_price"], item["qty"], item["discount"])
+            for item in st.session_state["cart"].values()
+        )
+        cached_cart = st.session_state.get("cart_display_cache")
+        if cached_cart is None or cached_cart[0] != cart_key:
+            cart_data = pd.DataFrame(list(st.session_state["cart"].values()))
+            cart_data['subtotal'] = cart_data['qty'] * (cart_data['unit_price'] - cart_data['discount'])
+            cart_data['delete'] = False  # Add delete checkbox column
+            cached_cart = (cart_key, cart_data)
+            st.session_state["cart_display_cache"] = cached_cart
+        cart_data = cached_cart[1]
+        
+        # Create formatted columns for display
+        display_df = cart_data[["product_name", "qty", "unit_price", "discount", "subtotal", "delete"]]
+        
+        # Data editor with delete checkbox
+        edited_df = st.data_editor(
+            display_df,
+            column_config={
+                "product_name": st.column_config.TextColumn("Product", disabled=True),
+                "qty": st.column_config.NumberColumn("Quantity", disabled=True),
+                "unit_price": st.column_config.NumberColumn("Unit Price", format="$%.2f", disabled=True),
+                "discount": st.column_config.NumberColumn("Discount per unit", format="$%.2f", disabled=True),
+                "subtotal": st.column_config.NumberColumn("Subtotal", format="$%.2f", disabled=True),
+                "delete": st.column_config.CheckboxColumn("Select to Delete", default=False),
+            },
+            use_container_width=True,
+            hide_index=True,
+            num_rows="fixed"
+        )
+        
+        # Remove selected items button
+        if st.button("🗑️ Remove Selected Items"):
+            selected_rows = np.flatnonzero(edited_df['delete'].to_numpy(dtype=bool)).tolist()
+            if selected_rows:
+                # Editor rows follow cart order, so map row positions back to product_id keys
+                cart_keys = list(st.session_state["cart"])
+                for idx in selected_rows:
+                    del st.session_state["cart"][cart_keys[idx]]
+                st.success(f"Removed {len(selected_rows)} item(s) from cart.")
+                st.rerun()
+            else:
+                st.warning("No items selected for removal.")
+        
+        # Calculate and display grand total
+        # Removals rerun before reaching here, so cart_data still matches the cart
+        grand_total = float(cart_data["subtotal"].sum())
+        st.markdown(f"**Grand Total: {format_currency(grand_total)}**")
+
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            if st.button("🗑️ Clear Entire Cart"):
+                st.session_state["cart"] = {}
+                st.session_state.pop("cart_display_cache", None)
+                st.rerun()
+        with col2:
+            pass  # Placeholder for future actions
+        with col3:
+            # Checkout
+            if grand_total > 0:
+                with st.popover("Complete Sale"):
+                    with st.form("checkout"):
+                        # Left blank, record_sale allocates the number inside the sale's own transaction, so
+                        # rendering, abandoning or a rejected checkout consumes none
+                        invoice = st.text_input("Invoice Number", placeholder="Assigned automatically", key="invoice_num")
+                        customer_name = st.text_input("Customer Name (optional)")
+                        notes = st.text_area("Notes (optional)")
+                        submitted = st.form_submit_button(f"💳 Complete Sale for {format_currency(grand_total)}")
+                        if submitted:
+                            try:
+                                sold_by = st.session_state["user"]["id"]
+                                # Copy cart before recording
+                                last_sale_items = list(st.session_state["cart"].values())
+                                with pool.write() as conn:
+                                    invoice, total_amount = record_sale(conn, invoice.strip(), last_sale_items, sold_by)
+                                st.session_state["last_sale"] = {
+                                    "invoice": invoice,
+                                    "total": total_amount,
+                                    "customer": customer_name,
+                                    "notes": notes,
+                                    "items": last_sale_items
+                                }
+                                st.session_state["cart"] = {}
+                                st.session_state.pop("cart_display_cache", None)
+                                st.success(f"Sale completed! Invoice: {invoice}, Total: {format_currency(total_amount)}")
+                                st.info("💡 Sale recorded! Navigate to Dashboard to see live metrics (stock updated, sales reflected).")
+                                st.rerun()
+                            except Exception as e:
+                                st.error(f"Sale failed: {e}")
+            else:
+                st.warning("Grand Total is zero. Cannot complete sale.")
+
+
+        # Last Sale Receipt - Updated to show items
+        if st.session_state["last_sale"]:
+            st.subheader("🧾 Last Sale Receipt")
+            st.write(f"**Invoice #:** {st.session_state['last_sale']['invoice']}")
+            st.write(f"**Date:** {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+            if st.session_state['last_sale'].get('customer'):
+                st.write(f"**Customer:** {st.session_state['last_sale']['customer']}")
+            
+            # Items table
+            if "items" in st.session_state["last_sale"] and st.session_state["last_sale"]["items"]:
+                receipt_df = pd.DataFrame(st.session_state["last_sale"]["items"])
+                receipt_df["line_total"] = receipt_df["qty"] * (receipt_df["unit_price"] - receipt_df["discount"])
+                # Format from the raw ndarrays; astype(str) would drop trailing zeros ("$1.5/unit")
+                receipt_df["unit_price"] = [format_currency(v) for v in receipt_df["unit_price"].to_numpy()]
+                receipt_df["discount"] = [f"${v:.2f}/unit" for v in receipt_df["discount"].to_numpy()]
+                receipt_df["line_total"] = [format_currency(v) for v in receipt_df["line_total"].to_numpy()]
+                st.subheader("Items:")
+                st.table(receipt_df[["product_name", "qty", "unit_price", "discount", "line_total"]])
+            
+            st.markdown("---")
+            st.write(f"**Grand Total:** {format_currency(st.session_state['last_sale']['total'])}")
+            if st.session_state['last_sale'].get('notes'):
+                st.write(f"**Notes:** {st.session_state['last_sale']['notes']}")
+            
+            # Undo
+            if st.button("↩️ Undo Last Sale (Admin Only)", disabled=st.session_state["user"]["role"] != "admin"):
+                if st.session_state["user"]["role"] == "admin":
+                    try:
+                        with pool.write() as conn:
+                            undo_sale(conn, st.session_state["last_sale"]["invoice"], st.session_state["user"]["id"])
+                        st.session_state.pop("last_sale")
+                        st.success("Sale undone")
+                        st.rerun()
+                    except Exception as e:
+                        st.error(f"Undo failed: {e}")
+                else:
+                    st.error("Only Admins can undo sales.")
+            
+            # New: Auto-suggest navigating to Dashboard after sale
+            if st.button("📊 View Updated Dashboard"):
+                st.session_state["page"] = "Dashboard"
+                st.rerun()
+    else:
+        st.info("Cart is empty. Add products to start.")
+
+def sales_page(pool):
     st.header("💰 Sales")
-    prod_df = get_products(conn)
+    prod_df = cached_get_products()
     # Rebuilding prod_map to store per-unit discount if it was somehow in the cart, 
     # but the cart handles per-unit discount amount.
-    prod_map = {row["name"]: {"id": row["id"], "price": row["price"], "cost": row["cost"], "quantity": row["quantity"]} for _, row in prod_df.iterrows()} if not prod_df.empty else {}
+    # Names aren't unique in products, so zip records onto names (last one wins) rather than to_dict(orient="index")
+    prod_map = dict(zip(prod_df["name"].tolist(), prod_df[["id", "price", "cost", "quantity"]].to_dict(orient="records")))
 
+    # Cart lines keyed by product_id (insertion-ordered), so adding an existing product is a lookup
     if "cart" not in st.session_state:
-        st.session_state["cart"] = []
+        st.session_state["cart"] = {}
     if "last_sale" not in st.session_state:
         st.session_state["last_sale"] = None
 
@@ -1251,37 +2081,29 @@ def sales_page(conn):
     sale_tab, history_tab = st.tabs(["🛒 Process Sales", "📈 Sales History"])
 
     with sale_tab:
-        # Product Search and Add to Cart - Updated UX: Use widgets + button for better control and reset
+        # Product Search and Add to Cart - the inputs sit in a form so only submitting reruns the page,
+        # and clear_on_submit resets them for the next addition
         st.subheader("🛍️ Add Products to Cart")
         st.info("💡 Tip: Select a different product each time to add multiple unique items. Same product quantities will combine.")
         
-        # Initialize session state for widget control if needed
-        if "cart_product_idx" not in st.session_state:
-            st.session_state.cart_product_idx = 0
-        if "add_qty" not in st.session_state:
-            st.session_state.add_qty = 1
-        elif st.session_state.add_qty < 1:
-            st.session_state.add_qty = 1
-        if "add_disc" not in st.session_state:
-            st.session_state.add_disc = 0.0
-        
-        product_options = ["-- select --"] + sorted([f"{row['name']} (Stock: {row['quantity']}, Price: {format_currency(row['price'])})" for _, row in prod_df.iterrows()])
-        selected_product = st.selectbox(
-            "Select Product",
-            product_options,
-            index=st.session_state.cart_product_idx,
-            key="cart_product"
-        )
+        # prod_df already comes back ORDER BY name, so the labels are built in display order
+        product_options = ["-- select --"] + [
+            f"{name} (Stock: {quantity}, Price: {format_currency(price)})"
+            for name, quantity, price in zip(prod_df["name"].tolist(), prod_df["quantity"].tolist(), prod_df["price"].tolist())
+        ]
+        with st.form("add_to_cart_form", clear_on_submit=True):
+            selected_product = st.selectbox("Select Product", product_options, key="cart_product")
+            col1, col2 = st.columns(2)
+            with col1:
+                qty = st.number_input("Qty", min_value=1, value=1, step=1, key="cart_qty")
+            with col2:
+                discount_pct = st.number_input("Discount %", min_value=0.0, max_value=100.0, value=0.0, format="%.2f", key="cart_discount")
+            add_submitted = st.form_submit_button("➕ Add to Cart")
         product_name = selected_product.split(" (")[0] if selected_product != "-- select --" else None
         
-        col1, col2 = st.columns(2)
-        with col1:
-            qty_value = max(1, st.session_state.add_qty)
-            qty = st.number_input("Qty", min_value=1, value=qty_value, step=1, key="cart_qty")
-        with col2:
-            discount_pct = st.number_input("Discount %", min_value=0.0, max_value=100.0, value=st.session_state.add_disc, format="%.2f", key="cart_discount")
-        
-        if st.button("➕ Add to Cart", disabled=not product_name):
+        if add_submitted and not product_name:
+            st.warning("Select a product to add.")
+        elif add_submitted:
             try:
                 if product_name not in prod_map:
                     raise ValueError("Product not found in current inventory.")
@@ -1294,7 +2116,7 @@ def sales_page(conn):
                 # Discount is per-unit discount amount
                 per_unit_discount = round(unit_price * (discount_pct / 100), 2)
                 
-                existing = next((item for item in st.session_state["cart"] if item["product_id"] == pid), None)
+                existing = st.session_state["cart"].get(pid)
                 
                 if existing:
                     new_qty = existing["qty"] + qty
@@ -1308,7 +2130,7 @@ def sales_page(conn):
                     if qty > available:
                         st.error(f"Only {available} available")
                     else:
-                        st.session_state["cart"].append({
+                        st.session_state["cart"][pid] = {
                             "product_id": pid,
                             "product_name": product_name,
                             "qty": qty,
@@ -1316,149 +2138,15 @@ def sales_page(conn):
                             "unit_cost": unit_cost,
                             "discount": per_unit_discount, # This is the per-unit discount amount
                             "available_qty": available
-                        })
+                        }
                         st.success(f"Added {qty} x {product_name}")
-                
-                # Reset widgets for next addition
-                st.session_state.cart_product_idx = 0
-                st.session_state.add_qty = 1
-                st.session_state.add_disc = 0.0
-                st.rerun()
             except ValueError as e:
                 st.error(str(e))
             except Exception as e:
                 st.error(f"Error: {e}")
 
         # Cart Display and Edit
-        if st.session_state["cart"]:
-            st.subheader("🛒 Cart Summary")
-            
-            # Prepare display DataFrame
-            cart_data = pd.DataFrame(st.session_state["cart"])
-            cart_data['subtotal'] = cart_data['qty'] * (cart_data['unit_price'] - cart_data['discount'])
-            cart_data['delete'] = False  # Add delete checkbox column
-            
-            # Create formatted columns for display
-            display_df = cart_data[["product_name", "qty", "unit_price", "discount", "subtotal", "delete"]].copy()
-            display_df["unit_price"] = display_df["unit_price"].apply(format_currency)
-            display_df["discount"] = display_df["discount"].apply(format_currency)
-            display_df["subtotal"] = display_df["subtotal"].apply(format_currency)
-            
-            # Data editor with delete checkbox
-            edited_df = st.data_editor(
-                display_df,
-                column_config={
-                    "product_name": st.column_config.TextColumn("Product", disabled=True),
-                    "qty": st.column_config.NumberColumn("Quantity", disabled=True),
-                    "unit_price": st.column_config.TextColumn("Unit Price", disabled=True),
-                    "discount": st.column_config.TextColumn("Discount per unit", disabled=True),
-                    "subtotal": st.column_config.TextColumn("Subtotal", disabled=True),
-                    "delete": st.column_config.CheckboxColumn("Select to Delete", default=False),
-                },
-                use_container_width=True,
-                hide_index=True,
-                num_rows="fixed"
-            )
-            
-            # Remove selected items button
-            if st.button("🗑️ Remove Selected Items"):
-                selected_rows = edited_df[edited_df['delete'] == True].index.tolist()
-                if selected_rows:
-                    # Remove from cart in reverse order to preserve indices
-                    for idx in sorted(selected_rows, reverse=True):
-                        del st.session_state["cart"][idx]
-                    st.success(f"Removed {len(selected_rows)} item(s) from cart.")
-                    st.rerun()
-                else:
-                    st.warning("No items selected for removal.")
-            
-            # Calculate and display grand total
-            unformatted_cart_df = pd.DataFrame(st.session_state["cart"])
-            grand_total = (unformatted_cart_df["qty"] * (unformatted_cart_df["unit_price"] - unformatted_cart_df["discount"])).sum()
-            st.markdown(f"**Grand Total: {format_currency(grand_total)}**")
-
-            col1, col2, col3 = st.columns(3)
-            with col1:
-                if st.button("🗑️ Clear Entire Cart"):
-                    st.session_state["cart"] = []
-                    st.rerun()
-            with col2:
-                pass  # Placeholder for future actions
-            with col3:
-                # Checkout
-                if grand_total > 0:
-                    with st.popover("Complete Sale"):
-                        with st.form("checkout"):
-                            invoice = st.text_input("Invoice Number", value=generate_invoice(conn), key="invoice_num")
-                            customer_name = st.text_input("Customer Name (optional)")
-                            notes = st.text_area("Notes (optional)")
-                            submitted = st.form_submit_button(f"💳 Complete Sale for {format_currency(grand_total)}")
-                            if submitted:
-                                try:
-                                    sold_by = st.session_state["user"]["id"]
-                                    # Copy cart before recording
-                                    last_sale_items = st.session_state["cart"].copy()
-                                    total_amount = record_sale(conn, invoice, st.session_state["cart"], sold_by)
-                                    st.session_state["last_sale"] = {
-                                        "invoice": invoice,
-                                        "total": total_amount,
-                                        "customer": customer_name,
-                                        "notes": notes,
-                                        "items": last_sale_items
-                                    }
-                                    st.session_state["cart"] = []
-                                    st.success(f"Sale completed! Invoice: {invoice}, Total: {format_currency(total_amount)}")
-                                    st.info("💡 Sale recorded! Navigate to Dashboard to see live metrics (stock updated, sales reflected).")
-                                    st.rerun()
-                                except Exception as e:
-                                    st.error(f"Sale failed: {e}")
-                else:
-                    st.warning("Grand Total is zero. Cannot complete sale.")
-
-
-            # Last Sale Receipt - Updated to show items
-            if st.session_state["last_sale"]:
-                st.subheader("🧾 Last Sale Receipt")
-                st.write(f"**Invoice #:** {st.session_state['last_sale']['invoice']}")
-                st.write(f"**Date:** {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-                if st.session_state['last_sale'].get('customer'):
-                    st.write(f"**Customer:** {st.session_state['last_sale']['customer']}")
-                
-                # Items table
-                if "items" in st.session_state["last_sale"] and st.session_state["last_sale"]["items"]:
-                    receipt_items = st.session_state["last_sale"]["items"].copy()
-                    receipt_df = pd.DataFrame(receipt_items)
-                    receipt_df["line_total"] = receipt_df["qty"] * (receipt_df["unit_price"] - receipt_df["discount"])
-                    receipt_df["unit_price"] = receipt_df["unit_price"].apply(format_currency)
-                    receipt_df["discount"] = receipt_df["discount"].apply(lambda x: f"${x:.2f}/unit")
-                    receipt_df["line_total"] = receipt_df["line_total"].apply(format_currency)
-                    st.subheader("Items:")
-                    st.table(receipt_df[["product_name", "qty", "unit_price", "discount", "line_total"]])
-                
-                st.markdown("---")
-                st.write(f"**Grand Total:** {format_currency(st.session_state['last_sale']['total'])}")
-                if st.session_state['last_sale'].get('notes'):
-                    st.write(f"**Notes:** {st.session_state['last_sale']['notes']}")
-                
-                # Undo
-                if st.button("↩️ Undo Last Sale (Admin Only)", disabled=st.session_state["user"]["role"] != "admin"):
-                    if st.session_state["user"]["role"] == "admin":
-                        try:
-                            undo_sale(conn, st.session_state["last_sale"]["invoice"], st.session_state["user"]["id"])
-                            st.session_state.pop("last_sale")
-                            st.success("Sale undone")
-                            st.rerun()
-                        except Exception as e:
-                            st.error(f"Undo failed: {e}")
-                    else:
-                        st.error("Only Admins can undo sales.")
-                
-                # New: Auto-suggest navigating to Dashboard after sale
-                if st.button("📊 View Updated Dashboard"):
-                    st.session_state["page"] = "Dashboard"
-                    st.rerun()
-        else:
-            st.info("Cart is empty. Add products to start.")
+        _cart_section(pool)
 
     with history_tab:
         st.subheader("Sales History")
@@ -1468,52 +2156,41 @@ def sales_page(conn):
         with col2:
             hist_to = st.date_input("To", value=date.today())
         search = st.text_input("Search by Product or Invoice")
-        hist_df = get_sales(conn, hist_from.isoformat(), hist_to.isoformat())
-        if search:
-            hist_df = hist_df[hist_df["product_name"].str.contains(search, case=False, na=False) | hist_df["invoice"].str.contains(search, case=False, na=False)]
-        
-        if not hist_df.empty:
-            # Group by invoice for summary
-            grouped = hist_df.groupby("invoice").agg({
-                "product_name": lambda x: " | ".join(x),
-                "total": "sum",
-                "sold_at": "first",
-                "sold_by_username": "first"
-            }).reset_index()
-            grouped.rename(columns={"product_name": "Items", "sold_by_username": "Sold By"}, inplace=True)
-            grouped["total"] = grouped["total"].apply(format_currency)
-            
+        # Summary grouped by invoice in SQL (already newest first)
+        grouped = cached_get_sales_by_invoice(hist_from.isoformat(), hist_to.isoformat(), search or None)
+
+        if not grouped.empty:
+            grouped.rename(columns={"items": "Items", "sold_by_username": "Sold By"}, inplace=True)
+
             st.data_editor(
-                grouped[["invoice", "Items", "total", "sold_at", "Sold By"]].sort_values("sold_at", ascending=False), 
+                grouped[["invoice", "Items", "total", "sold_at", "Sold By"]],
+                column_config={"total": st.column_config.NumberColumn("total", format="$%.2f")},
                 use_container_width=True,
                 hide_index=True
             )
+            hist_df = cached_get_sales(hist_from.isoformat(), hist_to.isoformat(), search=search or None)
             csv_bytes = dataframe_to_csv_bytes(hist_df)
             st.download_button("Export CSV (Detailed)", csv_bytes, f"sales_history_{hist_from}_{hist_to}.csv")
         else:
             st.info("No sales found.")
 
+# Page routers per role, in sidebar order
+ADMIN_PAGES = {
+    "Dashboard": dashboard_page,
+    "Sales": sales_page,
+    "Products": products_page,
+    "Users": users_page,
+}
+# For non-admin, only Sales and Products in order
+USER_PAGES = {
+    "Sales": sales_page,
+    "Products": products_page,
+}
+
 def main():
-    conn = get_connection()
-    init_db(conn)
-    if login_area(conn):
-        page_names_to_funcs = {
-            "Sales": sales_page,
-            "Products": products_page,
-        }
-        if st.session_state["user"]["role"] == "admin":
-            page_names_to_funcs = {
-                "Dashboard": dashboard_page,
-                "Sales": sales_page,
-                "Products": products_page,
-                "Users": users_page
-            }
-        else:
-            # For non-admin, only Sales and Products in order
-            page_names_to_funcs = {
-                "Sales": sales_page,
-                "Products": products_page,
-            }
+    pool = get_pool()
+    if login_area(pool):
+        page_names_to_funcs = ADMIN_PAGES if st.session_state["user"]["role"] == "admin" else USER_PAGES
         
         st.sidebar.title(APP_TITLE)
         
@@ -1528,11 +2205,10 @@ def main():
             selected_page = st.sidebar.selectbox("Navigate", list(page_names_to_funcs.keys()))
 
         page_func = page_names_to_funcs[selected_page]
-        page_func(conn)
+        page_func(pool)
     else:
         st.title(APP_TITLE)
         st.info("Please log in to access the system.")
-    conn.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file